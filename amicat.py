@@ -0,0 +1,126 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import cache
+
+from awsutil import paginate
+
+# Local catalog of public images per (region,owner), with 'self' recorded
+# per account (see catalog). The first sync
+# downloads the full listing, later syncs only fetch images created since
+# the newest CreationDate seen (the creation-date filter only takes
+# wildcards so this is done as one 'YYYY-MM-DD*' value per day).
+
+SYNC_TTL = 3600
+RESYNC = 7 * 86400
+MAXDAYS = 200
+BATCH = 500
+
+BASE = [ {'Name':'image-type','Values':['machine']},
+         {'Name':'is-public','Values':['true']},
+         {'Name':'state','Values':['available']} ]
+
+# EC2 filter name -> catalog column
+FILTERS = { 'image-id': 'id',
+            'name': 'name',
+            'description': 'description',
+            'architecture': 'arch',
+            'platform': 'platform',
+            'root-device-type': 'root_device',
+            'virtualization-type': 'virtualization' }
+
+# One connection shared by every thread (a resident awsd runs each command
+# on its own thread), used under lock
+lock = threading.RLock()
+db = None
+
+def connect():
+    global db
+    if db is None:
+        os.makedirs(cache.DIR,exist_ok=True)
+        db = sqlite3.connect(os.path.join(cache.DIR,'ami.db'),timeout=30,check_same_thread=False)
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS image (
+                id TEXT, region TEXT, owner TEXT, name TEXT, description TEXT,
+                arch TEXT, platform TEXT, root_device TEXT, virtualization TEXT,
+                created TEXT, data TEXT, PRIMARY KEY (region,owner,id));
+            CREATE INDEX IF NOT EXISTS image_created ON image (region,owner,created);
+            CREATE INDEX IF NOT EXISTS image_arch ON image (region,owner,arch,platform,created);
+            CREATE VIRTUAL TABLE IF NOT EXISTS image_text USING fts5(
+                description, content='image', tokenize='trigram');
+            CREATE TRIGGER IF NOT EXISTS image_ai AFTER INSERT ON image BEGIN
+                INSERT INTO image_text(rowid,description) VALUES (new.rowid,new.description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS image_ad AFTER DELETE ON image BEGIN
+                INSERT INTO image_text(image_text,rowid,description) VALUES ('delete',old.rowid,old.description);
+            END;
+            CREATE TABLE IF NOT EXISTS sync (
+                region TEXT, owner TEXT, synced REAL, full REAL, latest TEXT,
+                PRIMARY KEY (region,owner));
+        ''')
+    return db
+
+def days(since):
+    d,today = datetime.date.fromisoformat(since[:10]),datetime.datetime.utcnow().date()
+    return [ (d + datetime.timedelta(n)).isoformat() + '*' for n in range((today - d).days + 1) ]
+
+def catalog(client,owner):
+    # (region,owner) the images are stored under
+    account,region = cache.scope(client)
+    return region,'self:' + account if owner == 'self' else owner
+
+def sync(client,owner,refresh=False):
+    with lock:
+        c = connect()
+        (region,stored),now = catalog(client,owner),time.time()
+        state = c.execute('SELECT synced,full,latest FROM sync WHERE region=? AND owner=?',(region,stored)).fetchone()
+        if state and not refresh and now - state[0] < SYNC_TTL:
+            return
+        full = not state or not state[2] or now - state[1] > RESYNC or len(days(state[2])) > MAXDAYS
+        filters = BASE if full else BASE + [{'Name':'creation-date','Values':days(state[2])}]
+        latest = '' if full else state[2]
+        with c:
+            if full:
+                c.execute('DELETE FROM image WHERE region=? AND owner=?',(region,stored))
+            for i in paginate(client,'describe_images','Images',Owners=[owner],Filters=filters):
+                c.execute('DELETE FROM image WHERE region=? AND owner=? AND id=?',(region,stored,i['ImageId']))
+                c.execute('INSERT INTO image VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                            (i['ImageId'],region,stored,i.get('Name',''),i.get('Description',''),
+                             i.get('Architecture',''),i.get('Platform','linux'),i.get('RootDeviceType',''),
+                             i.get('VirtualizationType',''),i.get('CreationDate',''),json.dumps(i)))
+                latest = max(latest,i.get('CreationDate',''))
+            c.execute('INSERT OR REPLACE INTO sync VALUES (?,?,?,?,?)',
+                        (region,stored,now,now if full else state[1],latest))
+
+def indexable(filters):
+    return all(n in FILTERS for n,v in filters)
+
+def query(client,owner,match=None,filters=(),latest=False):
+    region,owner = catalog(client,owner)
+    where,args = ['image.region=?','image.owner=?'],[region,owner]
+    if match and len(match) >= 3:
+        where.append('image.rowid IN (SELECT rowid FROM image_text WHERE image_text MATCH ?)')
+        args.append('"{}"'.format(match.replace('"','""')))
+    for n,v in filters:
+        where.append('image.{} GLOB ?'.format(FILTERS[n]))
+        args.append(v)
+    sql = 'SELECT data,description FROM image WHERE {} ORDER BY created DESC'.format(' AND '.join(where))
+    # Rows are fetched in batches so the lock is not held while yielding
+    with lock:
+        cursor = connect().execute(sql,args)
+    while True:
+        with lock:
+            rows = cursor.fetchmany(BATCH)
+        if not rows:
+            return
+        for data,description in rows:
+            # The trigram index is case-insensitive, --match is not
+            if match and match not in description:
+                continue
+            yield json.loads(data)
+            if latest:
+                return
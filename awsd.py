@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+
+# Resident process for ec2.py/lightsail.py: `awsd.py serve` keeps boto3,
+# sessions, clients, parsed field specs and the cache connections warm and
+# runs commands sent over a Unix socket; `awsd.py ec2 ls ...` is the thin
+# client (falling back to running the tool directly if nothing is
+# listening) and `awsd.py repl` dispatches commands in-process.
+#
+# Commands are run one at a time, as the tools configure process-wide
+# state (cache/throttle/trace options, cwd) per command. Interactive
+# commands, and requests whose AWS_* environment differs from the
+# server's, are run locally by the client instead.
+#
+# Frames are a channel byte, a 4 byte length and the payload: b'1'/b'2'
+# stdout/stderr data, b'x' exit status, b'l' run locally instead.
+
+TOOLS = ( 'ec2','lightsail' )
+
+# Commands the client runs itself because they attach ssh to the caller's
+# terminal, prompt or read stdin - always, or only with/without an option
+LOCAL = { ('ec2','ssh'),('lightsail','ssh'),('lightsail','cmd') }
+LOCAL_WITH = { ('lightsail','new'):('--shell','--config') }
+LOCAL_WITHOUT = { ('lightsail','rm'):('--force',) }
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def socket_path():
+    return os.getenv('AWS_UTILS_SOCKET') or os.path.join(
+                os.getenv('XDG_RUNTIME_DIR') or os.path.join(os.getenv('XDG_CACHE_HOME') or
+                    os.path.expanduser('~/.cache'),'aws-utils'),'awsd.sock')
+
+def environment():
+    return { k:v for k,v in os.environ.items() if k.startswith('AWS_') and k != 'AWS_UTILS_SOCKET' }
+
+def frame(channel,data):
+    return channel + struct.pack('>I',len(data)) + data
+
+def recv(f):
+    head = f.read(5)
+    if len(head) < 5:
+        return None,None
+    return head[:1],f.read(struct.unpack('>I',head[1:])[0])
+
+def command(argv):
+    # (tool,subcommand) skipping group options (all take a value except flags)
+    flags = { '--no-cache','--refresh','--verbose','-v','--help' }
+    args = iter(argv[1:])
+    for a in args:
+        if not a.startswith('-'):
+            return argv[0],a
+        if a not in flags and '=' not in a:
+            next(args,None)
+    return argv[0],None
+
+def interactive(argv):
+    cmd = command(argv)
+    given = lambda options: any(a == o or a.startswith(o + '=') for a in argv[1:] for o in options)
+    # '-' is stdin for the click.File options
+    return (cmd in LOCAL or '-' in argv[1:] or
+            (cmd in LOCAL_WITH and given(LOCAL_WITH[cmd])) or
+            (cmd in LOCAL_WITHOUT and not given(LOCAL_WITHOUT[cmd])))
+
+def local(argv):
+    os.execv(sys.executable,[sys.executable,os.path.join(ROOT,argv[0] + '.py')] + argv[1:])
+
+def client(argv):
+    if interactive(argv):
+        local(argv)
+    s = socket.socket(socket.AF_UNIX)
+    try:
+        s.connect(socket_path())
+    except OSError:
+        local(argv)
+    f = s.makefile('rwb')
+    f.write(json.dumps({ 'argv':argv,'cwd':os.getcwd(),'env':environment() }).encode() + b'\n')
+    f.flush()
+    out = { b'1':sys.stdout.buffer,b'2':sys.stderr.buffer }
+    while True:
+        channel,data = recv(f)
+        if channel in out:
+            out[channel].write(data)
+            out[channel].flush()
+        elif channel == b'l':
+            local(argv)
+        else:
+            sys.exit(int(data) if channel == b'x' else 1)
+
+# Server side: sys.stdout/sys.stderr/sys.stdin are replaced with proxies
+# that route each handler thread to its own connection
+
+class Channel(io.RawIOBase):
+
+    def __init__(self,sock,channel):
+        self.sock,self.channel = sock,channel
+
+    def write(self,data):
+        self.sock.sendall(frame(self.channel,bytes(data)))
+        return len(data)
+
+    def writable(self):
+        return True
+
+class Proxy:
+
+    def __init__(self,default):
+        self.default = default
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local,'stream',None) or self.default
+
+    def __getattr__(self,name):
+        return getattr(self.target(),name)
+
+    def write(self,s):
+        return self.target().write(s)
+
+    def flush(self):
+        return self.target().flush()
+
+def dispatch(argv):
+    import click
+    import traceback
+    tool = __import__(argv[0])
+    try:
+        rc = tool.cli.main(argv[1:],prog_name=argv[0] + '.py',standalone_mode=False)
+        return rc if isinstance(rc,int) else 0
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.echo("Aborted!",err=True)
+        return 1
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code,int):
+            return e.code or 0
+        click.echo(e.code,err=True)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+def serve(path):
+    import signal
+    import socketserver
+    import click
+    for t in TOOLS:
+        __import__(t)
+    import awsutil
+    awsutil.session()
+    env,lock = environment(),threading.Lock()
+    proxies = [ Proxy(sys.stdout),Proxy(sys.stderr),Proxy(sys.stdin) ]
+    sys.stdout,sys.stderr,sys.stdin = proxies
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            argv = request['argv']
+            if not argv or argv[0] not in TOOLS or request['env'] != env or interactive(argv):
+                self.wfile.write(frame(b'l',b''))
+                return
+            streams = [ io.TextIOWrapper(io.BufferedWriter(Channel(self.connection,c)),encoding='utf-8',
+                                            line_buffering=True,write_through=True) for c in (b'1',b'2') ]
+            streams.append(io.TextIOWrapper(io.BytesIO(b'')))
+            for p,s in zip(proxies,streams):
+                p.local.stream = s
+            try:
+                with lock:
+                    os.chdir(request['cwd'])
+                    rc = dispatch(argv)
+                    for s in streams[:2]:
+                        s.flush()
+                self.wfile.write(frame(b'x',str(rc).encode()))
+            except OSError:
+                pass
+            finally:
+                for p in proxies:
+                    p.local.stream = None
+    class Server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+        daemon_threads = True
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    try:
+        socket.socket(socket.AF_UNIX).connect(path)
+        click.echo("ERROR: Already serving on {}".format(path),err=True)
+        sys.exit(1)
+    except FileNotFoundError:
+        pass
+    except ConnectionRefusedError:
+        os.unlink(path)
+    umask = os.umask(0o077)
+    try:
+        server = Server(path,Handler)
+    finally:
+        os.umask(umask)
+    click.echo("Serving on {}".format(path),err=True)
+    signal.signal(signal.SIGTERM,lambda *a: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def repl():
+    import shlex
+    import click
+    try:
+        import readline
+    except ImportError:
+        pass
+    tool = 'ec2'
+    while True:
+        try:
+            line = input("{}> ".format(tool))
+        except EOFError:
+            click.echo()
+            return
+        except KeyboardInterrupt:
+            click.echo()
+            continue
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            click.echo("ERROR: {}".format(e),err=True)
+            continue
+        if not argv:
+            continue
+        if argv[0] in ('exit','quit'):
+            return
+        # A leading tool name switches tools, otherwise the last one is used
+        if argv[0] in TOOLS:
+            tool,argv = argv[0],argv[1:]
+            if not argv:
+                continue
+        try:
+            rc = dispatch([tool] + argv)
+        except KeyboardInterrupt:
+            rc = 130
+        if rc:
+            click.echo("[exit {}]".format(rc),err=True)
+
+def main(argv):
+    if argv[:1] == ['serve']:
+        serve(argv[1] if len(argv) > 1 else socket_path())
+    elif argv[:1] == ['repl']:
+        repl()
+    elif argv[:1] and argv[0] in TOOLS:
+        client(argv)
+    else:
+        sys.stderr.write("Usage: awsd.py serve [SOCKET] | repl | {{{}}} ARGS...\n".format(','.join(TOOLS)))
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
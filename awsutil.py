@@ -0,0 +1,232 @@
+import collections
+import functools
+import hashlib
+import os
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+import tracing
+
+WORKERS = 16
+QUEUE = 1000
+MIN_RATE = 0.5
+
+# Error codes AWS services use to signal request throttling
+THROTTLES = { 'Throttling','ThrottlingException','ThrottledException','RequestThrottledException',
+              'RequestLimitExceeded','TooManyRequestsException','RequestThrottled','SlowDown',
+              'EC2ThrottledException','BandwidthLimitExceeded','PriorRequestNotComplete' }
+
+config = { 'rate':None, 'inflight':WORKERS, 'attempts':10 }
+inflight = threading.BoundedSemaphore(WORKERS)
+held = threading.local()
+
+def configure(rate=None,max_inflight=WORKERS,max_attempts=10):
+    # Called per command; a resident awsd process keeps the buckets (and
+    # the rates they have learned) but reports each command's own counts
+    global inflight
+    config.update(rate=rate or None,inflight=max_inflight,attempts=max_attempts)
+    inflight = threading.BoundedSemaphore(max(1,max_inflight))
+    with buckets_lock:
+        for b in buckets.values():
+            b.reset(config['rate'])
+
+def paginate(client,op,key,**params):
+    for page in client.get_paginator(op).paginate(**params):
+        yield from page.get(key,[])
+
+# boto3 is imported on first use so that --help and usage errors do not
+# pay for it, and sessions/clients are built once per process. Every
+# client uses adaptive retries and goes through the shared throttle.
+
+@functools.lru_cache(maxsize=None)
+def session(profile=None):
+    with tracing.span('import','boto3'):
+        import boto3.session
+    with tracing.span('client','session',profile=profile):
+        return boto3.session.Session(profile_name=profile)
+
+@functools.lru_cache(maxsize=None)
+def scope(profile=None,region=None):
+    # (account,region) that cached responses and endpoints are keyed by:
+    # the profile name, plus the access key id when the credentials come
+    # from the environment (which botocore only uses without an explicit
+    # profile), so that nothing cached is shared between accounts
+    s = session(profile)
+    account,key = s.profile_name,os.getenv('AWS_ACCESS_KEY_ID')
+    if key and profile is None:
+        account += ':' + hashlib.sha1(key.encode()).hexdigest()[:12]
+    return account,region or s.region_name
+
+class Bucket:
+    # Token bucket shared by every client for a service/region. It starts
+    # unlimited (or at --rate) and adapts AIMD-style: a throttling error
+    # halves the rate relative to what was actually being sent, each
+    # success raises it by roughly one request/sec per second.
+
+    def __init__(self,rate=None):
+        self.limit = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.sent = collections.deque()
+        self.lock = threading.Lock()
+        self.requests = self.retries = self.throttled = 0
+        self.waited = 0.0
+
+    def reset(self,rate=None):
+        with self.lock:
+            self.limit = rate
+            if rate:
+                self.rate = min(self.rate or rate,rate)
+            self.requests = self.retries = self.throttled = 0
+            self.waited = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.sent.append(now)
+            while self.sent[0] < now - 1:
+                self.sent.popleft()
+            if self.rate is None:
+                # Keep last current so the first throttle (which sets a
+                # rate) does not refill from the bucket's creation time
+                self.last = now
+                return
+            self.tokens = min(max(1.0,self.rate),self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                with tracing.span('throttle',rate=self.rate):
+                    time.sleep(wait)
+                self.waited += wait
+                self.tokens = 1.0
+                self.last = time.monotonic()
+            self.tokens -= 1
+
+    def update(self,attempt,throttled):
+        with self.lock:
+            self.requests += 1
+            self.retries += attempt > 1
+            if throttled:
+                self.throttled += 1
+                self.rate = max(MIN_RATE,0.5 * min(self.rate or len(self.sent),len(self.sent) or MIN_RATE))
+                self.tokens = min(self.tokens,0.0)
+            elif self.rate is not None:
+                self.rate += 1 / self.rate
+                if self.limit:
+                    self.rate = min(self.rate,self.limit)
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+def bucket(service,region):
+    with buckets_lock:
+        if (service,region) not in buckets:
+            buckets[(service,region)] = Bucket(config['rate'])
+        return buckets[(service,region)]
+
+def throttle(client):
+    b = bucket(client.meta.service_model.service_name,client.meta.region_name)
+    def before_send(**kwargs):
+        # Send and response-received run on the same thread; the slot is
+        # released on the semaphore it was taken from even if configure()
+        # has replaced it since (as a resident awsd process does)
+        sem = held.sem = inflight
+        sem.acquire()
+        try:
+            b.acquire()
+        except BaseException:
+            held.sem = None
+            sem.release()
+            raise
+    def received(parsed_response,context,**kwargs):
+        sem,held.sem = getattr(held,'sem',None),None
+        if sem:
+            sem.release()
+        code = (parsed_response or {}).get('Error',{}).get('Code')
+        b.update(context.get('retries',{}).get('attempt',1),code in THROTTLES)
+    client.meta.events.register('before-send',before_send)
+    client.meta.events.register('response-received',received)
+    return client
+
+def report():
+    for (service,region),b in sorted(buckets.items(),key=lambda i: (i[0][0],i[0][1] or '')):
+        if not b.requests:
+            continue
+        click.echo("{}/{}: {} requests, {} retries, {} throttled, {:.1f}s waiting{}".format(
+                        service,region,b.requests,b.retries,b.throttled,b.waited,
+                        ", {:.1f} req/s limit".format(b.rate) if b.rate else ""),err=True)
+
+def client(service,region=None,profile=None):
+    return build(service,region,profile,config['attempts'],config['inflight'])
+
+@functools.lru_cache(maxsize=None)
+def build(service,region,profile,attempts,max_inflight):
+    # Keyed on the retry and pool settings as well, so a later command
+    # with different --max-attempts/--max-inflight gets its own client
+    from botocore.config import Config
+    c = Config(retries={'mode':'adaptive','max_attempts':attempts},
+               max_pool_connections=max(10,max_inflight))
+    s = session(profile)
+    with tracing.span('client',service,region=region,profile=profile):
+        c = throttle(s.client(service,region_name=region,config=c))
+    c.scope = scope(profile,region)
+    return tracing.hook(c)
+
+def all_regions(service,profile=None):
+    enabled = { r['RegionName'] for r in client('ec2',None,profile).describe_regions()['Regions'] }
+    return [ r for r in session(profile).get_available_regions(service) if r in enabled ]
+
+def targets(service,regions,profiles):
+    pairs = []
+    for profile in (profiles.split(',') if profiles else [None]):
+        if regions == 'all':
+            names = all_regions(service,profile)
+        elif regions:
+            names = regions.split(',')
+        else:
+            names = [session(profile).region_name]
+        pairs.extend((profile,r) for r in names)
+    return pairs
+
+def fanout(service,pairs,fn,workers=WORKERS):
+    # Runs fn(client) for each (profile,region) pair on a bounded thread
+    # pool and yields (account,region,record) as records arrive. Clients
+    # are built up front as boto3 sessions are not thread-safe.
+    clients = [ (profile or 'default',region,client(service,region,profile)) for profile,region in pairs ]
+    q = queue.Queue(maxsize=QUEUE)
+    stop = threading.Event()
+    done = object()
+    def run(account,region,client):
+        try:
+            for record in fn(client):
+                if stop.is_set():
+                    return
+                q.put((account,region,record))
+        except Exception as e:
+            q.put((account,region,e))
+        finally:
+            q.put(done)
+    with ThreadPoolExecutor(max_workers=max(1,min(workers,len(clients)))) as pool:
+        for c in clients:
+            pool.submit(run,*c)
+        remaining = len(clients)
+        try:
+            while remaining:
+                item = q.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item[2],Exception):
+                    click.echo("{}/{}: {}".format(*item),err=True)
+                else:
+                    yield item
+        finally:
+            stop.set()
+            while remaining:
+                if q.get() is done:
+                    remaining -= 1
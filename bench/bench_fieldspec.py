@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Per-row cost of the compiled field spec against the original
+# regex/recursive ec2.extract, on synthetic describe_instances records
+
+import os
+import re
+import sys
+import time
+
+import click
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from fieldspec import parse
+
+FIELDS = """
+    id:InstanceId
+    type:InstanceType
+    ip:PublicIpAddress?
+    ami:ImageId
+    az:Placement.AvailabilityZone
+    key:KeyName
+    state:State.Name
+    security[,]:SecurityGroups.[].GroupId
+"""
+
+def legacy_getpath(data,path):
+    if '.' in path:
+        head,tail = path.split('.',1)
+        r = legacy_getpath(data,head)
+        if type(r) is range:
+            return [ legacy_getpath(data[i],tail) for i in r ]
+        else:
+            return legacy_getpath(r,tail)
+    elif path == '[]':
+        return range(0,len(data))
+    elif path[0] == '[':
+        return data[int(path[1:-1])]
+    else:
+        if path.endswith('?'):
+            return data.get(path[:-1],"")
+        else:
+            return data[path]
+
+def legacy_extract(data,*args):
+    r = {}
+    for arg in args:
+        try:
+            name,maxlen,fs,key = re.match(r'(.*?)(?:/(\d+))?(?:\[(.*)\])?:(.*)$',arg).groups()
+        except AttributeError:
+            name,maxlen,fs,key = arg,None,None,arg
+        v = legacy_getpath(data,key)
+        if fs:
+            v = fs.join(v)
+        if maxlen and len(v) > int(maxlen):
+            v = v[:int(maxlen)+3] + "..."
+        r[name] = v
+    return r
+
+def instance(n):
+    i = { 'InstanceId': 'i-{:017x}'.format(n),
+          'InstanceType': 't3.micro',
+          'ImageId': 'ami-{:08x}'.format(n % 50),
+          'Placement': { 'AvailabilityZone': 'eu-west-1' + 'abc'[n % 3] },
+          'KeyName': 'key-{}'.format(n % 7),
+          'State': { 'Name': 'running', 'Code': 16 },
+          'SecurityGroups': [ { 'GroupId': 'sg-{:08x}'.format(n % 11 + g),'GroupName': 'g' } 
+                                    for g in range(n % 3 + 1) ] }
+    if n % 2:
+        i['PublicIpAddress'] = '10.0.{}.{}'.format(n // 256 % 256,n % 256)
+    return i
+
+@click.command()
+@click.option('--rows',default=100000,help='Synthetic records')
+def bench(rows):
+    records = [ instance(n) for n in range(rows) ]
+    args = FIELDS.split()
+    t = time.perf_counter()
+    old = [ legacy_extract(i,*args) for i in records ]
+    legacy = time.perf_counter() - t
+    t = time.perf_counter()
+    spec = parse(FIELDS)
+    new = [ spec(i) for i in records ]
+    compiled = time.perf_counter() - t
+    assert old == new
+    click.echo("{} rows".format(rows))
+    click.echo("legacy:   {:.3f}s ({:.2f}us/row)".format(legacy,legacy/rows*1e6))
+    click.echo("compiled: {:.3f}s ({:.2f}us/row)".format(compiled,compiled/rows*1e6))
+    click.echo("speedup:  {:.1f}x".format(legacy/compiled))
+
+if __name__ == '__main__':
+    bench()
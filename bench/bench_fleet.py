@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# Listing commands against a synthetic fleet served by botocore's Stubber
+# (no network): 10k EC2 instances, 5k security groups, a 50k image AMI
+# catalog and 1k Lightsail instances. Each case runs the real click command
+# through CliRunner and reports wall time (best of -n), peak traced memory
+# and the number of API calls made.
+#
+#   bench/bench_fleet.py --save         record baseline
+#   bench/bench_fleet.py                compare against baseline
+#   bench/bench_fleet.py -k listsg      run matching cases only
+#
+# The baseline records the machine and Python it was taken on; timings
+# are only comparable on the same setup (calls always are).
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION','eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID','stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY','stub')
+
+from botocore.stub import Stubber
+from click.testing import CliRunner
+
+import amicat
+import awsutil
+import cache
+import ec2
+import lightsail
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'fleet.json')
+PAGE = 1000
+# Differences below these are noise whatever the tolerance (small cases
+# on a busy machine easily vary by tens of ms)
+NOISE = { 'ms':50,'peak_kb':256,'calls':0 }
+ZONES = [ 'eu-west-1a','eu-west-1b','eu-west-1c' ]
+
+def pages(items,key,token='NextToken',size=PAGE):
+    for n in range(0,len(items),size):
+        page = { key:items[n:n + size] }
+        if n + size < len(items):
+            page[token] = str(n + size)
+        yield page
+
+def instances(n):
+    return [ { 'InstanceId':'i-{:017x}'.format(i),
+               'InstanceType':('t3.micro','m5.large','c6g.xlarge')[i % 3],
+               'ImageId':'ami-{:017x}'.format(i % 50),
+               'Placement':{ 'AvailabilityZone':ZONES[i % 3] },
+               'KeyName':'key-{}'.format(i % 10),
+               'State':{ 'Name':('running','stopped')[i % 7 == 0], 'Code':16 },
+               'PublicIpAddress':'10.{}.{}.{}'.format(i >> 16 & 255,i >> 8 & 255,i & 255),
+               'SecurityGroups':[ { 'GroupId':'sg-{:017x}'.format((i + j) % 5000),'GroupName':'sg{}'.format(j) }
+                                    for j in range(3) ],
+               'Tags':[ { 'Key':'Name','Value':'host-{}'.format(i) } ] } for i in range(n) ]
+
+def reservations(n):
+    # A few instances per reservation, as run_instances --count produces
+    i = instances(n)
+    return [ { 'ReservationId':'r-{}'.format(r),'Instances':i[r:r + 4] } for r in range(0,n,4) ]
+
+def security_groups(n):
+    def permission(i,j):
+        p = { 'IpProtocol':('tcp','udp','-1')[j % 3],
+              'IpRanges':[ { 'CidrIp':'10.{}.{}.0/24'.format(i & 255,k) } for k in range(j % 4 + 1) ],
+              'Ipv6Ranges':[ { 'CidrIpv6':'2001:db8:{:x}::/48'.format(i) } ] if j % 5 == 0 else [],
+              'UserIdGroupPairs':[ { 'GroupId':'sg-{:017x}'.format((i + 1) % n) } ] if j % 4 == 0 else [],
+              'PrefixListIds':[] }
+        if p['IpProtocol'] != '-1':
+            p['FromPort'],p['ToPort'] = 1000 + j * 10,1000 + j * 10 + (j % 2) * 100
+        return p
+    return [ { 'GroupId':'sg-{:017x}'.format(i),'GroupName':'group-{}'.format(i),
+               'Description':'Synthetic security group {}'.format(i),'VpcId':'vpc-1',
+               'IpPermissions':[ permission(i,j) for j in range(20) ],
+               'IpPermissionsEgress':[] } for i in range(n) ]
+
+def images(n):
+    return [ { 'ImageId':'ami-{:017x}'.format(i),'Name':'image-{}'.format(i),
+               'Description':'{} {} image build {}'.format(('Amazon Linux 2023','Ubuntu 22.04','Windows Server 2022')[i % 3],
+                                                           ('x86_64','arm64')[i % 2],i),
+               'Architecture':('x86_64','arm64')[i % 2],
+               **({ 'Platform':'windows' } if i % 3 == 2 else {}),
+               'RootDeviceType':'ebs','VirtualizationType':'hvm','State':'available','Public':True,
+               'CreationDate':'2024-{:02d}-{:02d}T00:00:00.000Z'.format(i % 12 + 1,i % 28 + 1) } for i in range(n) ]
+
+def lightsail_instances(n):
+    return [ { 'name':'ls-{}'.format(i),'state':{ 'name':'running' },
+               'location':{ 'availabilityZone':ZONES[i % 3] },
+               'publicIpAddress':'10.1.{}.{}'.format(i >> 8 & 255,i & 255),
+               'blueprintId':'ubuntu_22_04','username':'ubuntu','sshKeyName':'key-{}'.format(i % 5) } for i in range(n) ]
+
+# Fleets are built lazily and shared between cases
+FLEET = {}
+
+def fleet(name,build,*args):
+    if name not in FLEET:
+        FLEET[name] = build(*args)
+    return FLEET[name]
+
+def ec2_instances():
+    # MaxResults counts instances, so ~1000 instances per page
+    return [ ('describe_instances',p) for p in pages(fleet('reservations',reservations,10000),'Reservations',
+                                                      size=PAGE // 4) ]
+
+def ec2_groups():
+    return [ ('describe_security_groups',p) for p in pages(fleet('groups',security_groups,5000),'SecurityGroups') ]
+
+def ec2_images():
+    return [ ('describe_images',p) for p in pages(fleet('images',images,50000),'Images') ]
+
+def lightsail_fleet():
+    return [ ('get_instances',p) for p in pages(fleet('lightsail',lightsail_instances,1000),'instances',
+                                                 'nextPageToken',100) ]
+
+# name: (tool,argv,responses,setup) - setup is an (argv,responses) run made
+# before the measured runs, whose cache is then kept (e.g. the AMI catalog)
+CASES = {
+    'ec2 ls':                   (ec2,['ls'],ec2_instances,None),
+    'ec2 ls -o jsonl':          (ec2,['ls','-o','jsonl'],ec2_instances,None),
+    'ec2 ls --fields':          (ec2,['ls','--fields','id:InstanceId name:Tags.[].Value zone:Placement.AvailabilityZone'],
+                                    ec2_instances,None),
+    'ec2 ls --sort':            (ec2,['ls','--sort','-az,id'],ec2_instances,None),
+    'ec2 ls --group-by':        (ec2,['ls','--group-by','type,az','--group-by','security','--count'],ec2_instances,None),
+    'ec2 listsg':               (ec2,['listsg'],ec2_groups,None),
+    'ec2 listsg -o csv':        (ec2,['listsg','-o','csv'],ec2_groups,None),
+    'ec2 sgquery':              (ec2,['sgquery','-p','5432','-c','10.2.0.0/16','-m','overlap'],
+                                    lambda: ec2_groups() + ec2_instances(),None),
+    'ec2 listami (sync)':       (ec2,['listami','--latest'],ec2_images,None),
+    'ec2 listami --match':      (ec2,['listami','--match','Ubuntu 22.04 arm64'],lambda: [],(['listami'],ec2_images)),
+    'ec2 listami --no-cache':   (ec2,['--no-cache','listami','--arch','arm64'],ec2_images,None),
+    'lightsail ls':             (lightsail,['ls'],lightsail_fleet,None),
+    'lightsail ls -o jsonl':    (lightsail,['ls','-o','jsonl'],lightsail_fleet,None),
+    'lightsail ls --group-by':  (lightsail,['ls','--group-by','zone,blueprint'],lightsail_fleet,None),
+}
+
+def stub(tool,responses,calls):
+    c = awsutil.session().client(tool.__name__,region_name=os.environ['AWS_DEFAULT_REGION'])
+    c.meta.events.register('before-parameter-build',lambda **kw: calls.append(kw['model'].name))
+    s = Stubber(c)
+    for op,response in responses:
+        s.add_response(op,response)
+    s.activate()
+    return c
+
+def invoke(tool,argv,responses,cachedir):
+    for db in (cache.db,amicat.db):
+        if db:
+            db.close()
+    cache.DIR,cache.db,amicat.db = cachedir,None,None
+    calls = []
+    c = stub(tool,responses,calls)
+    tool.client = awsutil.client = lambda *a,**k: c
+    result = CliRunner().invoke(tool.cli,argv,catch_exceptions=False)
+    if result.exit_code:
+        raise click.ClickException("{} failed: {}".format(' '.join(argv),result.output[-500:]))
+    return len(calls)
+
+def machine():
+    return '{}, {} CPU(s), Python {}'.format(platform.platform(),os.cpu_count(),platform.python_version())
+
+def run(name,n):
+    tool,argv,responses,setup = CASES[name]
+    cachedir = tempfile.mkdtemp(prefix='bench-fleet-')
+    try:
+        if setup:
+            invoke(tool,setup[0],setup[1](),cachedir)
+        best = None
+        for i in range(n):
+            t = time.perf_counter()
+            calls = invoke(tool,argv,responses(),cachedir)
+            best = min(best or float('inf'),time.perf_counter() - t)
+            if not setup:
+                shutil.rmtree(cachedir)
+                os.makedirs(cachedir)
+        tracemalloc.start()
+        invoke(tool,argv,responses(),cachedir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return { 'ms':best * 1000,'peak_kb':peak / 1024,'calls':calls }
+    finally:
+        shutil.rmtree(cachedir,ignore_errors=True)
+
+@click.command()
+@click.option('-n',default=3,help='Runs per case')
+@click.option('-k','match',default=None,help='Run cases containing this string')
+@click.option('--save',is_flag=True,help='Save results as baseline')
+@click.option('--tolerance',default=0.25,help='Allowed slowdown/growth vs baseline')
+def bench(n,match,save,tolerance):
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except OSError:
+        baseline = {}
+    results,regressed = {},False
+    if baseline.get('recorded'):
+        click.echo("baseline: {}".format(baseline['recorded']))
+    click.echo("{:26} {:>10} {:>12} {:>6}".format('case','wall','peak mem','calls'))
+    for name in CASES:
+        if match and match not in name:
+            continue
+        r = results[name] = run(name,n)
+        base = baseline.get(name,{})
+        worse = [ k for k,limit in (('ms',tolerance),('peak_kb',tolerance),('calls',0))
+                    if k in base and r[k] > max(base[k] * (1 + limit),base[k] + NOISE[k]) ]
+        regressed = regressed or bool(worse)
+        click.echo("{:26} {:8.1f}ms {:9.0f}KB {:6}{}".format(name,r['ms'],r['peak_kb'],r['calls'],
+                    "  (baseline {:.1f}ms {:.0f}KB {}{})".format(base['ms'],base['peak_kb'],base['calls'],
+                        ' REGRESSION: ' + ','.join(worse) if worse else '') if base else ''))
+    if save:
+        with open(BASELINE,'w') as f:
+            json.dump({ **baseline,**results,'recorded':machine() },f,indent=2)
+    sys.exit(1 if regressed and not save else 0)
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Per-command ssh latency with and without connection multiplexing.
+# Needs a reachable sshd, e.g. a local one:
+#
+#   bench/bench_ssh.py --host 127.0.0.1 --user $USER --key ~/.ssh/id_ed25519
+
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+import sshutil
+
+def run(c,n):
+    times = []
+    for i in range(n):
+        t = time.perf_counter()
+        sshutil.check_key(c['key'])
+        sshutil.master(c)
+        subprocess.run(sshutil.args(c,'true'),stdin=subprocess.DEVNULL,check=True)
+        times.append(time.perf_counter() - t)
+    return times
+
+def report(label,times):
+    first,rest = times[0],sorted(times[1:]) or times
+    click.echo("{:8} first {:7.1f}ms  median {:7.1f}ms  p90 {:7.1f}ms".format(
+                    label,first * 1000,rest[len(rest) // 2] * 1000,rest[int(len(rest) * .9)] * 1000))
+
+def close(c):
+    subprocess.run(['ssh','-o','ControlPath={}'.format(sshutil.controlpath(c)),'-O','exit',c['ip']],
+                    stderr=subprocess.DEVNULL)
+
+@click.command()
+@click.option('--host',default='127.0.0.1',help='sshd host')
+@click.option('--user',default=os.getenv('USER'),help='User')
+@click.option('--key',required=True,help='Private key')
+@click.option('-n',default=20,help='Commands per mode')
+def bench(host,user,key,n):
+    c = sshutil.conn(key,user,host,'StrictHostKeyChecking=no','BatchMode=yes')
+    sshutil.configure('0')
+    report('direct',run(c,n))
+    sshutil.configure('60')
+    close(c)
+    report('mux',run(c,n))
+    close(c)
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Cold-start time of the command line tools: `--help` and an `ls` served
+# from a stubbed client (no network), each in a fresh interpreter.
+#
+#   bench/bench_startup.py --save       record baseline
+#   bench/bench_startup.py              compare against baseline
+#
+# The baseline records the machine and Python it was taken on; timings
+# are only comparable on the same setup.
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'startup.json')
+
+STUB = '''
+import os,sys
+sys.path.insert(0,{root!r})
+os.environ.setdefault('AWS_DEFAULT_REGION','eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID','stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY','stub')
+import awsutil
+from botocore.stub import Stubber
+client = awsutil.client
+def stubbed(service,region=None,profile=None):
+    c = client(service,region,profile)
+    s = Stubber(c)
+    s.add_response({op!r},{response!r})
+    s.activate()
+    return c
+awsutil.client = stubbed
+import {tool}
+{tool}.client = stubbed
+{tool}.cli(['ls'])
+'''
+
+RESPONSES = {
+    'ec2': ('describe_instances',{'Reservations':[{'Instances':[{'InstanceId':'i-0','InstanceType':'t3.micro',
+                'ImageId':'ami-0','Placement':{'AvailabilityZone':'eu-west-1a'},'KeyName':'k',
+                'State':{'Name':'running','Code':16},'SecurityGroups':[]}]}]}),
+    'lightsail': ('get_instances',{'instances':[{'name':'i-0','state':{'name':'running'},
+                'location':{'availabilityZone':'eu-west-1a'},'publicIpAddress':'10.0.0.1',
+                'blueprintId':'b','username':'u','sshKeyName':'k'}]}),
+}
+
+def cases():
+    for tool in ('ec2','lightsail'):
+        yield '{} --help'.format(tool),[sys.executable,os.path.join(ROOT,tool + '.py'),'--help']
+        op,response = RESPONSES[tool]
+        yield '{} ls (stub)'.format(tool),[sys.executable,'-c',STUB.format(root=ROOT,tool=tool,op=op,response=response)]
+
+def machine():
+    return '{}, {} CPU(s), Python {}'.format(platform.platform(),os.cpu_count(),platform.python_version())
+
+def measure(cmd,n):
+    times = []
+    for i in range(n):
+        t = time.perf_counter()
+        subprocess.run(cmd,stdout=subprocess.DEVNULL,check=True)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1000
+
+@click.command()
+@click.option('-n',default=10,help='Runs per case')
+@click.option('--save',is_flag=True,help='Save results as baseline')
+@click.option('--tolerance',default=0.25,help='Allowed slowdown vs baseline')
+def bench(n,save,tolerance):
+    results = { name:measure(cmd,n) for name,cmd in cases() }
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except OSError:
+        baseline = {}
+    regressed = False
+    if baseline.get('recorded'):
+        click.echo("baseline: {}".format(baseline['recorded']))
+    for name,ms in results.items():
+        base = baseline.get(name)
+        if base and ms > base * (1 + tolerance):
+            regressed = True
+        click.echo("{:20} {:7.1f}ms{}".format(name,ms,
+                    "  (baseline {:.1f}ms{})".format(base,' REGRESSION' if ms > base * (1 + tolerance) else '') 
+                        if base else ''))
+    if save:
+        with open(BASELINE,'w') as f:
+            json.dump({ 'recorded':machine(),**results },f,indent=2)
+    sys.exit(1 if regressed and not save else 0)
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Smoke runs of code paths the benchmarks don't reach, against stubbed
+# clients (no network, no ssh). Exits non-zero on the first failure.
+#
+#   bench/smoke.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+import click
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION','eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID','stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY','stub')
+
+from botocore.stub import Stubber
+
+import awsutil
+import cache
+import lightsail
+import sshrun
+
+def stub(service,responses):
+    c = awsutil.session().client(service,region_name=os.environ['AWS_DEFAULT_REGION'])
+    s = Stubber(c)
+    for op,response in responses:
+        s.add_response(op,response)
+    s.activate()
+    return c,s
+
+def instance(name,state,ip=None):
+    i = { 'name':name,'state':{ 'name':state },'username':'ubuntu','sshKeyName':'key' }
+    if ip:
+        i['publicIpAddress'] = ip
+    return i
+
+def wait_ready():
+    # lightsail new --shell/--config: polls get_instances until every
+    # instance is running with an IP, then waits for ssh
+    async def wait_ssh(c,interval=1):
+        pass
+    sshrun.wait_ssh = wait_ssh
+    c,s = stub('lightsail',[ ('get_instances',{ 'instances':[ instance('a','pending'),instance('b','pending') ] }),
+                             ('get_instances',{ 'instances':[ instance('a','running','10.0.0.1'),
+                                                              instance('b','running','10.0.0.2') ] }) ])
+    hosts = asyncio.run(lightsail.wait_ready(c,['a','b'],('StrictHostKeyChecking=no',)))
+    s.assert_no_pending_responses()
+    assert [ (n,h['ip']) for n,h in hosts ] == [ ('a','10.0.0.1'),('b','10.0.0.2') ],hosts
+
+SMOKE = { 'lightsail wait_ready': wait_ready }
+
+@click.command()
+def smoke():
+    cache.DIR = tempfile.mkdtemp(prefix='smoke-')
+    try:
+        for name,fn in SMOKE.items():
+            fn()
+            click.echo("ok  {}".format(name))
+    finally:
+        shutil.rmtree(cache.DIR,ignore_errors=True)
+
+if __name__ == '__main__':
+    smoke()
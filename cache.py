@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+import awsutil
+
+# On-disk response cache for slow-changing catalog calls. Entries are keyed
+# by (service,operation,account,region,params) and stored page by page so that
+# paginated listings can still be streamed on both hit and miss.
+
+DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),'aws-utils')
+MAXSIZE = 256 * 1024 * 1024
+
+TTL = { 'get_blueprints': 86400,
+        'get_bundles': 7 * 86400,
+        'get_key_pairs': 3600,
+        'describe_images': 86400,
+        'describe_key_pairs': 3600,
+        'describe_security_groups': 300 }
+
+# name/id -> (ip,user,key,state) for ssh/cmd, filled in by ls. Names
+# are only unique per account and region, so hosts are kept per scope
+HOST_TTL = 300
+
+config = { 'enabled': True, 'refresh': False }
+
+lock = threading.Lock()
+db = None
+
+def configure(enabled=True,refresh=False):
+    config.update(enabled=enabled,refresh=refresh)
+
+def connect():
+    global db
+    if db is None:
+        os.makedirs(DIR,exist_ok=True)
+        db = sqlite3.connect(os.path.join(DIR,'cache.db'),timeout=30,check_same_thread=False)
+        if db.execute('PRAGMA user_version').fetchone()[0] < 1:
+            # host was keyed by (tool,name) only
+            db.executescript('DROP TABLE IF EXISTS host; PRAGMA user_version=1;')
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS entry (
+                key TEXT PRIMARY KEY, service TEXT, operation TEXT, region TEXT,
+                created REAL, accessed REAL, size INTEGER, pages INTEGER);
+            CREATE TABLE IF NOT EXISTS page (
+                key TEXT, n INTEGER, data BLOB, PRIMARY KEY (key,n));
+            CREATE TABLE IF NOT EXISTS host (
+                tool TEXT, account TEXT, region TEXT, name TEXT, ip TEXT, user TEXT, key TEXT, state TEXT,
+                updated REAL, PRIMARY KEY (tool,account,region,name));
+        ''')
+    return db
+
+def scope(client):
+    # (account,region) of a client; clients not built by awsutil.client
+    # (eg. stubbed ones) are taken to use the default profile
+    return getattr(client,'scope',None) or awsutil.scope(None,client.meta.region_name)
+
+def cachekey(service,op,scope,params):
+    return hashlib.sha1(json.dumps([service,op,*scope,params],sort_keys=True,default=str).encode()).hexdigest()
+
+def lookup(key,ttl):
+    with lock:
+        c = connect()
+        r = c.execute('SELECT created,pages FROM entry WHERE key=?',(key,)).fetchone()
+        if not r or time.time() - r[0] > ttl:
+            return None
+        c.execute('UPDATE entry SET accessed=? WHERE key=?',(time.time(),key))
+        c.commit()
+        return r[1]
+
+def read(key,n):
+    with lock:
+        data, = connect().execute('SELECT data FROM page WHERE key=? AND n=?',(key,n)).fetchone()
+    return pickle.loads(zlib.decompress(data))
+
+def store(key,n,page):
+    blob = zlib.compress(pickle.dumps(page))
+    with lock:
+        c = connect()
+        if n == 0:
+            c.execute('DELETE FROM entry WHERE key=?',(key,))
+            c.execute('DELETE FROM page WHERE key=?',(key,))
+        c.execute('INSERT OR REPLACE INTO page VALUES (?,?,?)',(key,n,blob))
+        c.commit()
+
+def complete(key,service,op,region,n):
+    now = time.time()
+    with lock:
+        c = connect()
+        size, = c.execute('SELECT COALESCE(SUM(LENGTH(data)),0) FROM page WHERE key=?',(key,)).fetchone()
+        c.execute('INSERT OR REPLACE INTO entry VALUES (?,?,?,?,?,?,?,?)',(key,service,op,region,now,now,size,n))
+        evict(c)
+        c.commit()
+
+def evict(c):
+    total, = c.execute('SELECT COALESCE(SUM(size),0) FROM entry').fetchone()
+    for key,size in c.execute('SELECT key,size FROM entry ORDER BY accessed').fetchall():
+        if total <= MAXSIZE:
+            break
+        c.execute('DELETE FROM entry WHERE key=?',(key,))
+        c.execute('DELETE FROM page WHERE key=?',(key,))
+        total -= size
+
+def invalidate(service,op):
+    if not os.path.exists(os.path.join(DIR,'cache.db')):
+        return
+    with lock:
+        c = connect()
+        keys = c.execute('SELECT key FROM entry WHERE service=? AND operation=?',(service,op)).fetchall()
+        c.executemany('DELETE FROM page WHERE key=?',keys)
+        c.executemany('DELETE FROM entry WHERE key=?',keys)
+        c.commit()
+
+def pages(client,op,**params):
+    service,region = client.meta.service_model.service_name,client.meta.region_name
+    if client.can_paginate(op):
+        fetch = lambda: client.get_paginator(op).paginate(**params)
+    else:
+        fetch = lambda: [getattr(client,op)(**params)]
+    if not config['enabled'] or op not in TTL:
+        yield from fetch()
+        return
+    key = cachekey(service,op,scope(client),params)
+    n = None if config['refresh'] else lookup(key,TTL[op])
+    if n is not None:
+        for i in range(n):
+            yield read(key,i)
+        return
+    # The entry is only recorded once the listing has been read to the end
+    n = 0
+    for page in fetch():
+        page.pop('ResponseMetadata',None)
+        store(key,n,page)
+        n += 1
+        yield page
+    complete(key,service,op,region,n)
+
+def paginate(client,op,key,**params):
+    for page in pages(client,op,**params):
+        yield from page.get(key,[])
+
+def get_host(tool,scope,name):
+    if not config['enabled'] or config['refresh']:
+        return None
+    with lock:
+        r = connect().execute('SELECT name,ip,user,key,state,updated FROM host '
+                              'WHERE tool=? AND account=? AND region=? AND name=?',(tool,*scope,name)).fetchone()
+    return r[:5] if r and time.time() - r[5] < HOST_TTL else None
+
+def put_hosts(tool,scope,hosts):
+    if not config['enabled'] or not hosts:
+        return
+    now = time.time()
+    with lock:
+        c = connect()
+        c.executemany('INSERT OR REPLACE INTO host VALUES (?,?,?,?,?,?,?,?,?)',[ (tool,*scope,*h,now) for h in hosts ])
+        c.commit()
+
+def drop_host(tool,scope,name):
+    with lock:
+        c = connect()
+        c.execute('DELETE FROM host WHERE tool=? AND account=? AND region=? AND name=?',(tool,*scope,name))
+        c.commit()
+
+def remember(tool,scope,records,endpoint,batch=500):
+    # Pass records through, recording endpoint(record) for each
+    hosts = []
+    for r in records:
+        hosts.append(endpoint(r))
+        if len(hosts) >= batch:
+            put_hosts(tool,scope,hosts)
+            hosts = []
+        yield r
+    put_hosts(tool,scope,hosts)
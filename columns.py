@@ -0,0 +1,201 @@
+import array
+import itertools
+
+import click
+
+import tracing
+
+from output import fmt,isnum
+
+# Columnar table behind ls --sort/--group-by/--count/--sum. Rows are split
+# into typed columns as they arrive: ints and floats in arrays, anything
+# else dictionary encoded (a code per row into the column's distinct
+# values), so the usual low cardinality fields (type, zone, state...) cost
+# four bytes a row. Sorting ranks each distinct value once and then sorts
+# on integer ranks. Multi-valued fields are kept as tuples and joined on
+# output; --group-by counts a row once per element (eg. per security group).
+
+KINDS = ( None,'int','float','enc','obj' )
+ARRAYS = { 'int':'q','float':'d','enc':'I' }
+
+def kind(v):
+    if v is None or v == '':
+        return None
+    if isnum(v):
+        return 'int' if isinstance(v,int) else 'float'
+    return 'enc'
+
+def sortkey(v):
+    # Blank first, then numbers, then text
+    if v is None or v == '':
+        return (0,0,'')
+    if isnum(v):
+        return (1,v,'')
+    if isinstance(v,tuple):
+        return (2,0,','.join(map(fmt,v)))
+    return (2,0,fmt(v))
+
+class Column:
+
+    # Widened as values arrive (None -> int -> float -> enc -> obj); blanks
+    # in numeric columns are stored as 0 with the original value in nulls
+
+    def __init__(self,name,join=None):
+        self.name,self.join = name,join
+        self.kind,self.n,self.data = None,0,None
+        self.nulls,self.values,self.index = {},[],{}
+
+    def get(self,i):
+        if self.kind == 'enc':
+            return self.values[self.data[i]]
+        if self.kind == 'obj':
+            return self.data[i]
+        return self.nulls[i] if i in self.nulls else self.data[i]
+
+    def store(self,v):
+        if self.kind == 'enc':
+            c = self.index.get(v)
+            if c is None:
+                c = self.index[v] = len(self.values)
+                self.values.append(v)
+            self.data.append(c)
+        elif self.kind == 'obj':
+            self.data.append(v)
+        else:
+            if v is None or v == '':
+                self.nulls[self.n],v = v,0
+            if self.data is not None:
+                self.data.append(v)
+        self.n += 1
+
+    def widen(self,kind):
+        old = [ self.get(i) for i in range(self.n) ]
+        self.kind,self.n,self.nulls,self.values,self.index = kind,0,{},[],{}
+        self.data = array.array(ARRAYS[kind]) if kind in ARRAYS else []
+        for v in old:
+            self.store(v)
+
+    def append(self,v):
+        if isinstance(v,list):
+            v = tuple(v)
+        k = max(self.kind,kind(v),key=KINDS.index)
+        if k != self.kind:
+            self.widen(k)
+        try:
+            self.store(v)
+        except OverflowError:
+            self.widen('enc')
+            self.store(v)
+        except TypeError:
+            # Unhashable (eg. a list of dicts) - kept as is
+            self.widen('obj')
+            self.store(v)
+
+    def output(self,i):
+        v = self.get(i)
+        if isinstance(v,tuple):
+            return self.join(v) if self.join else list(v)
+        return v
+
+    def sortkeys(self):
+        if self.kind == 'enc':
+            ranks = array.array('I',bytes(4 * len(self.values)))
+            for r,c in enumerate(sorted(range(len(self.values)),key=lambda c: sortkey(self.values[c]))):
+                ranks[c] = r
+            return [ ranks[c] for c in self.data ]
+        if self.kind == 'obj':
+            return [ sortkey(fmt(v)) for v in self.data ]
+        if self.kind is None:
+            return [0] * self.n
+        keys = list(self.data)
+        for i in self.nulls:
+            keys[i] = float('-inf')
+        return keys
+
+    def elements(self):
+        # Per row tuple of group values, several for multi-valued fields
+        if self.kind == 'obj':
+            raise click.BadParameter("can't group by {}".format(self.name),param_hint='--group-by')
+        if self.kind == 'enc':
+            elements = [ (v or ('',)) if isinstance(v,tuple) else (v,) for v in self.values ]
+            return [ elements[c] for c in self.data ]
+        return [ (self.get(i),) for i in range(self.n) ]
+
+class Table:
+
+    def __init__(self,names,joins={}):
+        self.columns = { n:Column(n,joins.get(n)) for n in names }
+        self.n = 0
+
+    def extend(self,rows):
+        columns = list(self.columns.values())
+        for row in rows:
+            for c in columns:
+                c.append(row.get(c.name))
+            self.n += 1
+
+    def order(self,keys):
+        order = list(range(self.n))
+        for k in reversed(keys):
+            key = self.columns[k.lstrip('-')].sortkeys()
+            order.sort(key=key.__getitem__,reverse=k.startswith('-'))
+        return order
+
+    def group(self,by,count,sums):
+        elements = [ self.columns[k].elements() for k in by ]
+        totals = []
+        for k in sums:
+            c = self.columns[k]
+            if c.kind not in (None,'int','float'):
+                raise click.BadParameter("{} is not numeric".format(k),param_hint='--sum')
+            totals.append([0] * self.n if c.data is None else c.data)
+        groups = {} if by else { ():[0] * (len(sums) + 1) }
+        for i in range(self.n):
+            for key in itertools.product(*[ e[i] for e in elements ]):
+                g = groups.get(key)
+                if g is None:
+                    g = groups[key] = [0] * (len(sums) + 1)
+                g[0] += 1
+                for j,t in enumerate(totals,1):
+                    g[j] += t[i]
+        names = list(by) + (['count'] if count or not sums else []) + list(sums)
+        table = Table(names)
+        table.extend(dict(zip(names,key + tuple(g if count or not sums else g[1:]))) for key,g in groups.items())
+        return table
+
+    def rows(self,order=None):
+        columns = list(self.columns.values())
+        for i in (range(self.n) if order is None else order):
+            yield { c.name:c.output(i) for c in columns }
+
+def split(values):
+    return [ v for value in values for v in value.split(',') if v ]
+
+def check(fields,names,option):
+    unknown = [ f for f in fields if f.lstrip('-') not in names ]
+    if unknown:
+        raise click.BadParameter("unknown field: {} (fields: {})".format(','.join(unknown),','.join(names)),
+                                    param_hint=option)
+
+def report_options(f):
+    f = click.option('--sum','sums',multiple=True,help='Total FIELD (per group with --group-by)')(f)
+    f = click.option('--count',is_flag=True,help='Count rows (per group with --group-by)')(f)
+    f = click.option('--group-by',multiple=True,help='Aggregate by FIELD[,FIELD...]')(f)
+    return click.option('--sort',multiple=True,help='Sort by FIELD[,FIELD...] (-FIELD descending)')(f)
+
+def report(rows,names,joins,sort=(),group_by=(),count=False,sums=()):
+    # Field names are checked before the listing is consumed
+    sort,by,sums = split(sort),split(group_by),split(sums)
+    check(by,names,'--group-by')
+    check(sums,names,'--sum')
+    if set(by) & set(sums):
+        raise click.BadParameter("can't group by and sum the same field",param_hint='--sum')
+    grouped = bool(by or count or sums)
+    check(sort,by + (['count'] if count or not sums else []) + sums if grouped else names,'--sort')
+    table = Table(names,joins)
+    with tracing.span('report','table') as span:
+        table.extend(rows)
+        if grouped:
+            table = table.group(by,count,sums)
+        span['rows'] = table.n
+    return table.rows(table.order(sort or by))
@@ -1,99 +1,133 @@
 #!/usr/bin/env python3
 
-import os
-import re 
 import subprocess
+import sys
+import time
 import textwrap
 
 import click
-import boto3
 
 from botocore.exceptions import ClientError
 
-from pprint import pprint
+import amicat
+import awsutil
+import cache
+import secgroups
+import sshutil
+import tracing
 
-from tabulate import tabulate
+from awsutil import client,fanout,paginate,targets
+from columns import report,report_options
+from fieldspec import parse
+from output import format_option,table,write
+from sshutil import args,conn,keypath
+from watch import watch,watch_options
 
-def getpath(data,path):
-    if '.' in path:
-        head,tail = path.split('.',1)
-        r = getpath(data,head)
-        if type(r) is range:
-            return [ getpath(data[i],tail) for i in r ]
-        else:
-            return getpath(r,tail)
-    elif path == '[]':
-        return range(0,len(data))
-    elif path[0] == '[':
-        return data[int(path[1:-1])]
-    else:
-        if path.endswith('?'):
-            return data.get(path[:-1],"")
-        else:
-            return data[path]
+@click.group()
+@click.option('--no-cache',is_flag=True,help='Bypass response cache')
+@click.option('--refresh',is_flag=True,help='Refresh cached responses')
+@click.option('--ssh-persist',default='10m',envvar='AWS_UTILS_SSH_PERSIST',help='SSH master idle lifetime (0 disables)')
+@click.option('--rate',type=float,default=None,envvar='AWS_UTILS_RATE',help='Max API requests/sec per service and region')
+@click.option('--max-inflight',type=int,default=16,envvar='AWS_UTILS_MAX_INFLIGHT',help='Max concurrent API requests')
+@click.option('--max-attempts',type=int,default=10,envvar='AWS_UTILS_MAX_ATTEMPTS',help='Max attempts per API request')
+@click.option('--verbose','-v',is_flag=True,help='Report API request/retry/throttle counts')
+@click.option('--trace',type=click.Path(dir_okay=False,writable=True),help='Write a timing trace (JSON) to file')
+@click.pass_context
+def cli(ctx,no_cache,refresh,ssh_persist,rate,max_inflight,max_attempts,verbose,trace):
+    cache.configure(enabled=not no_cache,refresh=refresh)
+    sshutil.configure(ssh_persist)
+    awsutil.configure(rate,max_inflight,max_attempts)
+    if verbose:
+        ctx.call_on_close(awsutil.report)
+    if trace:
+        tracing.enable(trace)
+        ctx.call_on_close(tracing.finish)
 
-def extract(data,*args):
-    r = {}
-    for arg in args:
-        try:
-            name,maxlen,fs,key = re.match('(.*?)(?:/(\d+))?(?:\[(.*)\])?:(.*)$',arg).groups()
-        except AttributeError:
-            name,maxlen,fs,key = arg,None,None,arg
-        v = getpath(data,key)
-        if fs:
-            v = fs.join(v)
-        if maxlen and len(v) > int(maxlen):
-            v = v[:int(maxlen)+3] + "..."
-        r[name] = v
-    return r
+def endpoint(i):
+    return (i['InstanceId'],i.get('PublicIpAddress',''),'',i.get('KeyName',''),i['State']['Name'])
 
-@click.group()
-def cli():
-    pass
+def resolve(id,refresh=False):
+    h = None if refresh else cache.get_host('ec2',awsutil.scope(),id)
+    if h and h[4] == 'running':
+        return { 'InstanceId':id, 'PublicIpAddress':h[1], 'KeyName':h[3], 'State':{'Name':h[4]} },True
+    ec2 = client('ec2')
+    i = ec2.describe_instances(InstanceIds=[id])['Reservations'][0]['Instances'][0]
+    cache.put_hosts('ec2',cache.scope(ec2),[endpoint(i)])
+    return i,False
 
 def parse_ip_permission(perms):
     res = []
     for p in perms:
-        if 'FromPort' in p:
-            fp,tp,proto = p['FromPort'],p['ToPort'],p['IpProtocol']
-            iprange = ",".join(['*' if x['CidrIp'] == '0.0.0.0/0' else x['CidrIp'] 
-                                        for x in p['IpRanges']])
-            ip6range = ",".join([x['CidrIpv6'] for x in p['Ipv6Ranges']])
-            ports = "{}".format(fp) if fp==tp else "{}-{}".format(fp,tp)
-            res.append("{}/{}:{}".format(proto,iprange,ports))
-        else:
-            res.append("*:*")
+        proto = secgroups.protocol(p['IpProtocol'])
+        fp,tp = (-1,-1) if proto == '-1' else (p['FromPort'],p['ToPort'])
+        res.append(secgroups.format_permission(proto,fp,tp,[ r[3] for r in secgroups.rules([p]) ]))
     return res
 
 @cli.command()
 @click.option("--filters",multiple=True,help="SG name")
 @click.option("--fields",help="Display fields")
-def listsg(filters,fields):
-    fields = fields.split() if fields else """
+@click.option("--regions",default=None,help="Regions (comma separated or 'all')")
+@click.option("--profiles",default=None,help="Profiles (comma separated)")
+@format_option
+def listsg(filters,fields,regions,profiles,fmt):
+    fields = parse(fields or """
         name/30:GroupName
         id:GroupId
         description/40:Description
-    """.split()
-    ec2 = boto3.client('ec2')
+    """)
     f = [ dict(Name=n,Values=[v]) for n,v in [ s.split('=') for s in filters] ]
-    r = ec2.describe_security_groups(Filters=f)
-    rows = []
-    for sg in r['SecurityGroups']:
-        header = True 
-        perm = parse_ip_permission(sg['IpPermissions'])
-        if perm:
-            for p in perm:
-                if header:
-                    row = extract(sg,*fields)
-                    row['ports'] = p
-                    header = False
-                else:
-                    row = {'ports':p}
-                rows.append(row)
-        else:
-            row = extract(sg,*fields)
-            rows.append(row)
-    print(tabulate(rows,headers='keys'))
+    def groups(client):
+        return paginate(client,'describe_security_groups','SecurityGroups',Filters=f)
+    def rows(records):
+        for tag,sg in records:
+            row = {**tag,**fields(sg)}
+            perm = parse_ip_permission(sg['IpPermissions'])
+            if perm:
+                row['ports'] = perm[0]
+                yield row
+                # Only the table output leaves continuation rows blank
+                for p in perm[1:]:
+                    yield {'ports':p} if fmt == 'table' else {**row,'ports':p}
+            else:
+                yield row
+    if regions or profiles:
+        records = ( ({'account':a,'region':r},sg) 
+                        for a,r,sg in fanout('ec2',targets('ec2',regions,profiles),groups) )
+    else:
+        records = ( ({},sg) for sg in groups(client('ec2')) )
+    write(rows(records),fmt)
+
+@cli.command()
+@click.option("--port","-p",default=None,help="Port or range (eg. 22, 8000-8100)")
+@click.option("--proto",default=None,help="Protocol (tcp/udp/icmp, default any)")
+@click.option("--cidr","-c",default=None,help="IPv4/IPv6 CIDR")
+@click.option("--match","-m",type=click.Choice(['contains','within','overlap']),default='contains',
+                help="Rule source contains (default), is within or overlaps --cidr")
+@click.option("--source","-s",default=None,help="Source security group or prefix list id")
+@click.option("--egress",is_flag=True,help="Query egress rules")
+@click.option("--instances/--no-instances",default=True,help="Show instances using each group")
+@format_option
+def sgquery(port,proto,cidr,match,source,egress,instances,fmt):
+    if cidr and not secgroups.network(cidr):
+        raise click.BadParameter("invalid CIDR: {}".format(cidr),param_hint='--cidr')
+    ec2 = client('ec2')
+    index = secgroups.Index(cache.paginate(ec2,'describe_security_groups','SecurityGroups'),egress)
+    found = index.query(proto,secgroups.parse_ports(port) if port else None,cidr,match,source)
+    users = {}
+    if instances and found:
+        ids = sorted({ g for g,r in found })
+        for batch in chunks(ids,BATCH):
+            for r in paginate(ec2,'describe_instances','Reservations',
+                                Filters=[{'Name':'instance.group-id','Values':batch}]):
+                for i in r['Instances']:
+                    for g in i.get('SecurityGroups',[]):
+                        users.setdefault(g['GroupId'],[]).append(i['InstanceId'])
+    def row(g,r):
+        row = { 'group':g,'name':index.groups[g].get('GroupName',''),'rule':secgroups.format_rule(r) }
+        if instances:
+            row['instances'] = ','.join(users.get(g,[]))
+        return row
+    write((row(g,r) for g,r in found),fmt)
 
 @cli.command()
 @click.option("--id","-i",required=True,help="Security Group Id")
@@ -101,71 +135,172 @@ def listsg(filters,fields):
 @click.option("--delete","-d",default=None,help="Delete rule")
 @click.option("--udp","-u",is_flag=True,help="UDP (default TCP)")
 def editsg(id,add,delete,udp):
-    ec2 = boto3.resource('ec2')
-    cidr,ports = add.split(':',1) if add else delete.split(':',1)
-    cidr = '0.0.0.0/0' if cidr == '*' else cidr
-    fp,tp = [ int(x) for x in (ports.split('-',1) if '-' in ports else (ports,ports)) ] 
-    sg = ec2.SecurityGroup(id)
+    ec2 = client('ec2')
+    cidr,ports = (add or delete).rsplit(':',1)
+    rules = secgroups.parse_rule("{}/{}:{}".format('udp' if udp else 'tcp',cidr,ports))
     if add:
-        sg.authorize_ingress(CidrIp=cidr,FromPort=fp,ToPort=tp,IpProtocol='udp' if udp else 'tcp')
+        ec2.authorize_security_group_ingress(GroupId=id,IpPermissions=secgroups.permissions(rules))
     else:
-        sg.revoke_ingress(CidrIp=cidr,FromPort=fp,ToPort=tp,IpProtocol='udp' if udp else 'tcp')
+        ec2.revoke_security_group_ingress(GroupId=id,IpPermissions=secgroups.permissions(rules))
+    cache.invalidate('ec2','describe_security_groups')
+
+@cli.command()
+@click.option("--id","-i",required=True,help="Security Group Id")
+@click.option("--rules","-r",required=True,type=click.File(),help="Rules file (YAML)")
+@click.option("--dry-run","-n",is_flag=True,help="Show changes only")
+@click.option("--keep",is_flag=True,help="Don't revoke rules missing from file")
+def syncsg(id,rules,dry_run,keep):
+    try:
+        import yaml
+    except ImportError:
+        click.echo("ERROR: syncsg requires PyYAML",err=True)
+        sys.exit(1)
+    desired = [ r for spec in (yaml.safe_load(rules) or []) for r in secgroups.parse_rule(spec) ]
+    ec2 = client('ec2')
+    try:
+        sg = ec2.describe_security_groups(GroupIds=[id])['SecurityGroups'][0]
+        add,remove = secgroups.diff(secgroups.rules(sg['IpPermissions']),desired)
+        if keep:
+            remove = []
+        for r in add:
+            click.echo("+ {}".format(secgroups.format_rule(r)))
+        for r in remove:
+            click.echo("- {}".format(secgroups.format_rule(r)))
+        if dry_run:
+            return
+        # Authorize before revoking so that replaced rules never leave a gap
+        if add:
+            ec2.authorize_security_group_ingress(GroupId=id,IpPermissions=secgroups.permissions(add))
+        if remove:
+            ec2.revoke_security_group_ingress(GroupId=id,IpPermissions=secgroups.permissions(remove))
+        cache.invalidate('ec2','describe_security_groups')
+    except ClientError as e:
+        click.echo(e,err=True)
+        sys.exit(1)
 
 @cli.command()
 @click.option("--name","-n",required=True,help="Name")
 @click.option("--description","-d",required=True,help="Description")
 def newsg(name,description):
-    ec2 = boto3.client('ec2')
+    ec2 = client('ec2')
     r = ec2.create_security_group(GroupName=name,Description=description)
+    cache.invalidate('ec2','describe_security_groups')
     click.echo(r['GroupId'])
 
 @cli.command()
 @click.option("--id","-i",required=True,help="Security Group Id")
 def delsg(id):
-    ec2 = boto3.client('ec2')
+    ec2 = client('ec2')
     ec2.delete_security_group(GroupId=id)
+    cache.invalidate('ec2','describe_security_groups')
 
 @cli.command()
 @click.option('--id',required=True,help="Instance Id")
 @click.option('--user',default="ec2-user",help="User Id")
 @click.argument('cmd',nargs=-1)
 def ssh(id,user,cmd):
-    ec2 = boto3.resource('ec2')
-    instance = ec2.Instance(id=id)
-    key = instance.key_name
-    ip = instance.public_ip_address
-    keypath = '{home}/.ssh/{key}'.format(home=os.getenv('HOME'),key=key)
-    args = [ 'ssh', 
-             '-i', keypath,
-             '-l', user,
-             ip ]
-    if cmd:
-        args.extend([' '.join(cmd)])
-    subprocess.run(args)
+    try:
+        instance,hit = resolve(id)
+    except (ClientError,IndexError) as e:
+        click.echo(e,err=True)
+        sys.exit(1)
+    def run(i):
+        c = conn(keypath(i['KeyName']),user,i['PublicIpAddress'])
+        return subprocess.run(args(c,' '.join(cmd)) if cmd else args(c)).returncode
+    rc = run(instance)
+    # ssh exits with 255 on connection errors - if the endpoint came from
+    # the cache re-resolve it and retry if it has changed
+    if rc == 255 and hit:
+        cache.drop_host('ec2',awsutil.scope(),id)
+        fresh,hit = resolve(id,refresh=True)
+        if endpoint(fresh) != endpoint(instance):
+            rc = run(fresh)
+    sys.exit(rc)
+
+# Instance ids per start/stop/terminate request and per status poll
+BATCH = 200
+POLL = 5
+
+ACTIONS = { 'start': ('start_instances','StartingInstances','running'),
+            'stop': ('stop_instances','StoppingInstances','stopped'),
+            'terminate': ('terminate_instances','TerminatingInstances','terminated') }
+
+def chunks(items,n):
+    return [ items[i:i+n] for i in range(0,len(items),n) ]
+
+def wait_state(ec2,ids,state,timeout):
+    # One describe_instance_status round per poll for everything still pending
+    pending,start = set(ids),time.time()
+    while pending and time.time() - start < timeout:
+        for chunk in chunks(sorted(pending),BATCH):
+            for s in paginate(ec2,'describe_instance_status','InstanceStatuses',
+                                InstanceIds=chunk,IncludeAllInstances=True):
+                if s['InstanceState']['Name'] == state:
+                    pending.discard(s['InstanceId'])
+        click.echo("\rWaiting: {}/{} {}".format(len(ids) - len(pending),len(ids),state),nl=False,err=True)
+        if pending:
+            time.sleep(POLL)
+    click.echo(err=True)
+    return pending
 
 @cli.command()
-@click.option('--id',required=True,help="Instance Id")
+@click.option('--id',multiple=True,help="Instance Id(s)")
+@click.option("--filters",multiple=True,help="Instance filters (as ls)")
 @click.option('--start',is_flag=True)
 @click.option('--stop',is_flag=True)
 @click.option('--terminate',is_flag=True)
-def cmd(id,start,stop,terminate):
-    ec2 = boto3.resource('ec2')
-    instance = ec2.Instance(id=id)
-    if start:
-        r = instance.start()
-    elif stop:
-        r = instance.stop()
-    elif terminate:
-        r = instance.terminate()
-    else:
+@click.option('--wait',is_flag=True,help="Wait for instances to reach target state")
+@click.option('--timeout',default=600,help="Wait timeout (seconds)")
+def cmd(id,filters,start,stop,terminate,wait,timeout):
+    action = 'start' if start else 'stop' if stop else 'terminate' if terminate else None
+    if not action:
         click.echo("No action specified",err=True)
-    pprint(r)
+        sys.exit(1)
+    if not (id or filters):
+        click.echo("ERROR: Instance id required (--id/--filters)",err=True)
+        sys.exit(1)
+    op,key,state = ACTIONS[action]
+    ec2 = client('ec2')
+    try:
+        ids = list(id)
+        if filters:
+            f = [ dict(Name=n,Values=[v]) for n,v in [ s.split('=') for s in filters] ]
+            ids.extend(i['InstanceId'] for r in paginate(ec2,'describe_instances','Reservations',Filters=f)
+                                            for i in r.get('Instances',[]))
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            click.echo("ERROR: No matching instances",err=True)
+            sys.exit(1)
+        def changes():
+            for chunk in chunks(ids,BATCH):
+                for i in getattr(ec2,op)(InstanceIds=chunk)[key]:
+                    yield { 'id':i['InstanceId'],
+                            'previous':i['PreviousState']['Name'],
+                            'current':i['CurrentState']['Name'] }
+        table(changes())
+        if wait:
+            pending = wait_state(ec2,ids,state,timeout)
+            if pending:
+                click.echo("ERROR: Timed out waiting for: {}".format(" ".join(sorted(pending))),err=True)
+                sys.exit(1)
+    except ClientError as e:
+        click.echo(e,err=True)
+        sys.exit(1)
 
 @cli.command()
 @click.option("--filters",multiple=True,help="SG name")
 @click.option("--fields",help="Display fields")
-def ls(filters,fields):
-    fields = fields.split() if fields else """
+@click.option("--regions",default=None,help="Regions (comma separated or 'all')")
+@click.option("--profiles",default=None,help="Profiles (comma separated)")
+@format_option
+@watch_options
+@report_options
+def ls(filters,fields,regions,profiles,fmt,interval,until,sort,group_by,count,sums):
+    reporting = bool(sort or group_by or count or sums)
+    if reporting and (interval or until):
+        click.echo("ERROR: --watch/--until can't be used with --sort/--group-by/--count/--sum",err=True)
+        sys.exit(1)
+    fields = parse(fields or """
         id:InstanceId
         type:InstanceType
         ip:PublicIpAddress?
@@ -174,15 +309,28 @@ def ls(filters,fields):
         key:KeyName
         state:State.Name
         security[,]:SecurityGroups.[].GroupId
-    """.split()
-    ec2 = boto3.client('ec2')
+    """)
     f = [ dict(Name=n,Values=[v]) for n,v in [ s.split('=') for s in filters] ]
-    r = ec2.describe_instances(Filters=f)
-    data = []
-    for i in getpath(r,'Reservations.[].Instances?.[0]'):
-        f = extract(i,*fields)
-        data.append(extract(i,*fields))
-    print(tabulate(data,headers='keys'))
+    record = fields.raw if reporting else fields
+    def instances(client):
+        for r in paginate(client,'describe_instances','Reservations',Filters=f):
+            yield from r.get('Instances',[])
+    if regions or profiles:
+        pairs = targets('ec2',regions,profiles)
+        def snapshot():
+            return ( ((a,r,i['InstanceId']),{'account':a,'region':r,**record(i)})
+                        for a,r,i in fanout('ec2',pairs,instances) )
+    else:
+        ec2 = client('ec2')
+        def snapshot():
+            return ( (i['InstanceId'],record(i)) for i in cache.remember('ec2',cache.scope(ec2),instances(ec2),endpoint) )
+    if interval or until:
+        watch(snapshot,interval,until,fmt)
+    elif reporting:
+        names = (['account','region'] if regions or profiles else []) + fields.names
+        write(report((row for k,row in snapshot()),names,fields.multi,sort,group_by,count,sums),fmt)
+    else:
+        write((row for k,row in snapshot()),fmt)
 
 @cli.command()
 @click.option("--ami",required=True,help="AMI Image Id")
@@ -193,9 +341,10 @@ def ls(filters,fields):
 @click.option("--max",default=1,help="Max Instances")
 @click.option("--sg",multiple=True,help="Security Group Ids")
 def new(ami,key,type,zone,min,max,sg):
-    ec2 = boto3.resource('ec2')
+    from pprint import pprint
+    ec2 = client('ec2')
     if zone:
-        response = ec2.create_instances(
+        response = ec2.run_instances(
                 ImageId=ami,
                 KeyName=key,
                 InstanceType=type,
@@ -205,7 +354,7 @@ def new(ami,key,type,zone,min,max,sg):
                 SecurityGroupIds=sg
         )
     else:
-        response = ec2.create_instances(
+        response = ec2.run_instances(
                 ImageId=ami,
                 KeyName=key,
                 InstanceType=type,
@@ -215,14 +364,17 @@ def new(ami,key,type,zone,min,max,sg):
         )
     pprint(response)
 
-
 @cli.command()
 @click.option('--params',default=None,help='Display parameters')
 @click.option('--filters',default=None,help='AMI filters')
 @click.option('--match',default=None,help='Match description')
 @click.option('--owner',default='amazon',help='AMI owner (default:amazon)')
 @click.option('--ami',default=None,help='AMI ID')
-def listami(params,filters,match,owner,ami):
+@click.option('--arch',default=None,help='Architecture')
+@click.option('--platform',default=None,help='Platform (linux/windows)')
+@click.option('--latest',is_flag=True,help='Latest matching image only')
+@format_option
+def listami(params,filters,match,owner,ami,arch,platform,latest,fmt):
     params = params or '''
         id:ImageId
         description:Description?
@@ -236,24 +388,32 @@ def listami(params,filters,match,owner,ami):
           makefilter('is-public','true'),
           makefilter('state','available'),
     ]
-    if filters:
-        for f in filters.split(','):
-            n,v = f.split('=',1)
-            filter_list.append(makefilter(n,v))
+    extra = [ tuple(f.split('=',1)) for f in filters.split(',') ] if filters else []
+    if arch:
+        extra.append(('architecture',arch))
+    if platform:
+        extra.append(('platform',platform))
     ids = [ami] if ami else []
 
-    params = params.split()
-    ec2 = boto3.client('ec2')
+    params = parse(params)
+    ec2 = client('ec2')
     try:
-        r = ec2.describe_images(Owners=[owner],Filters=filter_list,ImageIds=ids)
-        if match:
-            click.echo(tabulate([extract(x,*params) for x in r['Images'] if
-                match in x.get('Description','')],headers='keys'))
+        if cache.config['enabled'] and not ami and amicat.indexable(extra):
+            amicat.sync(ec2,owner,refresh=cache.config['refresh'])
+            images = amicat.query(ec2,owner,match,extra,latest)
         else:
-            click.echo(tabulate([extract(x,*params) for x in r['Images']],headers='keys'))
+            # There is no server-side filter for non-windows images
+            filter_list.extend(makefilter(n,v) for n,v in extra if (n,v) != ('platform','linux'))
+            images = cache.paginate(ec2,'describe_images','Images',Owners=[owner],Filters=filter_list,ImageIds=ids)
+            if platform == 'linux':
+                images = (x for x in images if 'Platform' not in x)
+            if match:
+                images = (x for x in images if match in x.get('Description',''))
+            if latest:
+                images = sorted(images,key=lambda x:x.get('CreationDate',''))[-1:]
+        write((params(x) for x in images),fmt)
     except ClientError as e:
         click.echo(e)
 
-
 if __name__ == '__main__':
     cli()
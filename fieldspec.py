@@ -0,0 +1,110 @@
+import functools
+import operator
+import re
+
+# Field spec syntax (shared by --fields/--params):
+#
+#   name[/maxlen][[sep]]:path  or  path
+#
+# path is a '.' separated list of steps: 'key', 'key?' (optional, '' if
+# missing), '[n]' (index) or '[]' (apply the rest of the path to each
+# element). Specs are parsed once into accessor closures so that applying
+# them to a record involves no string handling.
+
+FIELD = re.compile(r'(.*?)(?:/(\d+))?(?:\[(.*)\])?:(.*)$')
+
+class Missing(Exception):
+    pass
+
+def optional(key):
+    def get(data):
+        try:
+            return data[key]
+        except (KeyError,TypeError):
+            raise Missing()
+    return get
+
+def compile_path(path):
+    steps,getters = path.split('.'),[]
+    for i,step in enumerate(steps):
+        if step == '[]':
+            rest = compile_path('.'.join(steps[i+1:])) if steps[i+1:] else None
+            getters.append((lambda d,rest=rest: [ rest(x) for x in d ]) if rest else list)
+            break
+        elif step.startswith('['):
+            getters.append(operator.itemgetter(int(step[1:-1])))
+        elif step.endswith('?'):
+            getters.append(optional(step[:-1]))
+        else:
+            getters.append(operator.itemgetter(step))
+    if len(getters) == 1:
+        get = getters[0]
+    else:
+        def get(data,getters=tuple(getters)):
+            for g in getters:
+                data = g(data)
+            return data
+    if '?' not in path:
+        return get
+    def get_optional(data,get=get):
+        try:
+            return get(data)
+        except Missing:
+            return ""
+    return get_optional
+
+class Field:
+
+    __slots__ = ('name','path','sep','maxlen','get')
+
+    def __init__(self,spec):
+        m = FIELD.match(spec)
+        name,maxlen,sep,path = m.groups() if m else (spec,None,None,spec)
+        self.name,self.path,self.sep = name,path,sep
+        self.maxlen = int(maxlen) if maxlen else None
+        self.get = compile_path(path)
+
+    def join(self,v):
+        if self.sep is not None:
+            v = self.sep.join(v)
+        if self.maxlen and len(v) > self.maxlen:
+            v = v[:self.maxlen+3] + "..."
+        return v
+
+    def __call__(self,data):
+        return self.join(self.get(data))
+
+class Spec:
+
+    def __init__(self,fields):
+        self.fields = [ Field(f) for f in fields ]
+        self.names = [ f.name for f in self.fields ]
+        # Fields without join/truncation can be read with the bare accessor
+        self.getters = [ (f.name,f.get if f.sep is None and f.maxlen is None else f) for f in self.fields ]
+        # Columnar reports (columns.py) keep multi-valued fields as lists
+        # and join them on output
+        self.multi = { f.name:f.join for f in self.fields if f.sep is not None }
+        self.raw_getters = [ (f.name,f.get if f.sep is not None else get) for f,(name,get) in zip(self.fields,self.getters) ]
+
+    def __call__(self,data):
+        return { name:get(data) for name,get in self.getters }
+
+    def raw(self,data):
+        return { name:get(data) for name,get in self.raw_getters }
+
+@functools.lru_cache(maxsize=256)
+def parse_cached(fields):
+    return Spec(fields)
+
+def parse(spec):
+    return parse_cached(tuple(spec.split() if isinstance(spec,str) else spec))
+
+def extract(data,*args):
+    return parse(args)(data)
+
+@functools.lru_cache(maxsize=256)
+def accessor(path):
+    return compile_path(path)
+
+def getpath(data,path):
+    return accessor(path)(data)
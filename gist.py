@@ -1,12 +1,113 @@
 #!/usr/bin/env python3
 
+import codecs
 import configparser
+import email.utils
+import json
 import sys
+import time
 
-from base64 import encodestring
+from base64 import encodebytes
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import requests
+import urllib3
+
+import tracing
+
+# Files are read and encoded CHUNK bytes at a time and the request body is
+# streamed, so memory use doesn't depend on the size of the gist. CHUNK is
+# a multiple of 57 so base64 output is split into the same 76 character
+# lines as encoding the whole file at once.
+
+CHUNK = 57 * 1024
+
+def content(f,base64):
+    chunks = iter(lambda: f.read(CHUNK),b'')
+    if base64:
+        for chunk in chunks:
+            yield encodebytes(chunk).decode()
+    else:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in chunks:
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'',final=True)
+
+def body(description,public,files,base64):
+    yield '{{"description":{},"public":{},"files":{{'.format(json.dumps(description),json.dumps(public)).encode()
+    for n,(filename,f) in enumerate(files):
+        yield '{}{}:{{"content":"'.format(',' if n else '',json.dumps(filename)).encode()
+        for s in content(f,base64):
+            yield json.dumps(s)[1:-1].encode()
+        yield b'"}'
+    yield b'}}'
+
+# Retries back off exponentially unless the server says how long to wait
+# (Retry-After, or X-RateLimit-Reset once the rate limit is exhausted).
+# GitHub reports secondary rate limits as 403s, so those are retried when
+# they carry one of these headers. Creating a gist isn't idempotent, so a
+# 5xx or a dropped connection there may mean it was created: only rate
+# limits and failures to connect (nothing sent) are retried.
+
+RETRIES = 5
+RETRY_STATUS = { 429, 500, 502, 503, 504 }
+CREATE_RETRY_STATUS = { 429 }
+MAX_DELAY = 300
+WORKERS = 8
+
+def retry_delay(response,attempt):
+    h = response.headers if response is not None else {}
+    if 'Retry-After' in h:
+        try:
+            return min(float(h['Retry-After']),MAX_DELAY)
+        except ValueError:
+            return min(max(0,email.utils.parsedate_to_datetime(h['Retry-After']).timestamp() - time.time()),MAX_DELAY)
+    if h.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in h:
+        return min(max(0,int(h['X-RateLimit-Reset']) - time.time()),MAX_DELAY)
+    return min(2 ** attempt,MAX_DELAY)
+
+def retryable(response,status=RETRY_STATUS):
+    return response.status_code in status or (response.status_code == 403 and
+                ('Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0'))
+
+def not_sent(e):
+    # Connection refused, unresolved or timed out while connecting
+    reason = getattr(e.args[0],'reason',None) if e.args else None
+    return isinstance(e,requests.ConnectTimeout) or isinstance(reason,urllib3.exceptions.NewConnectionError)
+
+def request(session,method,url,retries=RETRIES,data=None,idempotent=True,**kwargs):
+    # data may be a callable returning a fresh body for each attempt
+    status = RETRY_STATUS if idempotent else CREATE_RETRY_STATUS
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method,url,data=data() if callable(data) else data,**kwargs)
+        except requests.ConnectionError as e:
+            if attempt == retries or not (idempotent or not_sent(e)):
+                raise
+            with tracing.span('retry',url):
+                time.sleep(retry_delay(None,attempt))
+            continue
+        if attempt == retries or not retryable(response,status):
+            return response
+        with tracing.span('retry',url,status=response.status_code):
+            time.sleep(retry_delay(response,attempt))
+
+def new_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2,pool_maxsize=WORKERS)
+    session.mount('https://',adapter)
+    session.mount('http://',adapter)
+    if tracing.enabled():
+        session.hooks['response'].append(tracing.http)
+    return session
+
+def shorten(session,short_url,url):
+    try:
+        response = request(session,'POST',short_url,files={'url':(None,url)},allow_redirects=False)
+        return response.headers['Location'] if response.ok else None
+    except requests.RequestException:
+        return None
 
 @click.command()
 @click.option('--description','-d',required=True,help='Gist description')
@@ -17,40 +118,57 @@ import requests
 @click.option('--config','-c',type=click.Path(exists=True),help='Account config')
 @click.option('--account','-a',help='GitHub account')
 @click.option('--token','-t',help='GitHub token')
-@click.argument("files",nargs=-1,type=click.File())
-def gist(description,files,name,private,short,base64,config,account,token):
-    req = { 'description': description,
-            'public': not private,
-            'files': {}
-            }
-    readf = (lambda f:encodestring(f.read().encode()).decode()) if base64 else (lambda f:f.read())
-    for f in files:
-        filename = name if (f.name == '<stdin>' and name) else f.name
-        req['files'][filename] = { 'content': readf(f) }
+@click.option('--api-url',default='https://api.github.com',envvar='GIST_API_URL',help='GitHub API base URL')
+@click.option('--short-url',default='https://git.io',envvar='GIST_SHORT_URL',help='URL shortener')
+@click.option('--trace',type=click.Path(dir_okay=False,writable=True),help='Write a timing trace (JSON) to file')
+@click.argument("files",nargs=-1,type=click.File('rb'))
+def gist(description,files,name,private,short,base64,config,account,token,api_url,short_url,trace):
+    if trace:
+        tracing.enable(trace)
+        click.get_current_context().call_on_close(tracing.finish)
+    files = [ (name if (f.name == '<stdin>' and name) else f.name,f) for f in files ]
     if config:
         c = configparser.ConfigParser()
         c.read(config)
         account = c['default']['account']
         token = c['gist']['token']
     auth = (account,(token or click.prompt('Token'))) if account else None
-    result = requests.post('https://api.github.com/gists',json=req,auth=auth)
+    # The body can only be resent if every file can be rewound
+    rewind = all(f.seekable() for n,f in files)
+    def data():
+        for n,f in files:
+            if rewind:
+                f.seek(0)
+        return body(description,not private,files,base64)
+    session = new_session()
+    try:
+        result = request(session,'POST',api_url.rstrip('/') + '/gists',data=data,retries=RETRIES if rewind else 0,
+                            idempotent=False,auth=auth,headers={'Content-Type':'application/json'})
+    except UnicodeDecodeError as e:
+        click.echo("ERROR: File is not UTF-8 text (use --base64): {}".format(e))
+        sys.exit(1)
+    except requests.RequestException as e:
+        click.echo("ERROR: {}".format(e))
+        sys.exit(1)
     if not result.ok:
         click.echo("ERROR: {} {}".format(result.status_code,result.json()['message']))
         sys.exit(1)
     else:
         api_response = result.json()
+        names = list(api_response['files'])
+        urls = [ api_response['files'][name]['raw_url'] for name in names ] + [ api_response['html_url'] ]
+        if short:
+            with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+                shorts = list(pool.map(lambda url: shorten(session,short_url,url),urls))
         click.echo("HTML URL: {}".format(api_response['html_url']))
         click.echo("API URL: {}".format(api_response['url']))
-        for name in api_response['files']:
-            click.echo("Raw URL ({}): {}".format(name,api_response['files'][name]['raw_url']))
+        for n,name in enumerate(names):
+            click.echo("Raw URL ({}): {}".format(name,urls[n]))
             if short:
-                response = requests.post('https://git.io',files={'url':(None,api_response['files'][name]['raw_url'])})
-                short_url = response.headers['Location'] if response.ok else 'Error creating short URL'
-                click.echo("Short URL ({}): {}".format(name,short_url))
+                click.echo("Short URL ({}): {}".format(name,shorts[n] or 'Error creating short URL'))
         if short:
-            response = requests.post('https://git.io',files={'url':(None,api_response['html_url'])})
-            if response.ok:
-                click.echo("Short URL: {}".format(response.headers['Location']))
+            if shorts[-1]:
+                click.echo("Short URL: {}".format(shorts[-1]))
             else:
                 click.echo("Error creating short URL")
         sys.exit(0)
@@ -1,82 +1,164 @@
 #!/usr/bin/env python3
 
-import boto3
 import click
-import os,subprocess,sys,time
+import fnmatch,subprocess,sys
+
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.exceptions import ClientError
-from tabulate import tabulate
 
-def getpath(val,path):
-    if '.' in path:
-        head,tail = path.split('.',2)
-        return getpath(val[head],tail)
-    else:
-        return val[path]
+import awsutil
+import cache
+import secgroups
+import sshutil
+import tracing
+
+from awsutil import client,fanout,paginate,targets
+from columns import report,report_options
+from fieldspec import extract,parse
+from output import format_option,table,write
+from sshutil import args,check_key,conn,keypath
+from watch import watch,watch_options
+
+def select(instances,names,running=False):
+    return [ i for i in instances if (running and i['state']['name'] == 'running') or
+                                        any(fnmatch.fnmatchcase(i['name'],n) for n in names) ]
+
+def missing(matched,names):
+    # Plain (non-glob) names that matched nothing are reported, so a typo
+    # in a list of names is not silently skipped
+    found = { i['name'] for i in matched }
+    unknown = [ n for n in names if not set(n) & set('*?[') and n not in found ]
+    for n in unknown:
+        click.echo("WARNING: No such instance: {}".format(n),err=True)
+    return bool(unknown)
+
+def endpoint(i):
+    return (i['name'],i.get('publicIpAddress',''),i['username'],i['sshKeyName'],i['state']['name'])
 
-def extract(val,*attrs):
-    i = {}
-    for a in attrs:
-        name,path = a.split(':',2) if ':' in a else (a,a)
-        i[name] = getpath(val,path)
-    return i
+def cached(h):
+    name,ip,user,key,state = h
+    return { 'name':name, 'publicIpAddress':ip, 'username':user, 'sshKeyName':key, 'state':{'name':state} }
 
-def check_key(key):
-    cmd = """ssh-keygen -y -f "{key}" </dev/null >/dev/null 2>&1 || 
-                    ssh-add -l | grep -q "{key}" ||
-                    ssh-add {key}""".format(key=key)
-    subprocess.run(cmd,shell=True)
+def instances(lightsail):
+    # Full listing, recorded in the endpoint cache as a side effect
+    return cache.remember('lightsail',cache.scope(lightsail),paginate(lightsail,'get_instances','instances'),endpoint)
+
+def resolve_one(name,refresh=False):
+    h = None if refresh else cache.get_host('lightsail',awsutil.scope(),name)
+    if h and h[4] == 'running':
+        return cached(h),True
+    lightsail = client('lightsail')
+    i = lightsail.get_instance(instanceName=name)['instance']
+    cache.put_hosts('lightsail',cache.scope(lightsail),[endpoint(i)])
+    return i,False
+
+def resolve(names,running=False):
+    # Plain names that are all cached (and running) need no API call,
+    # anything else is resolved from one get_instances listing
+    if not running and not any(set(n) & set('*?[') for n in names):
+        hosts = [ cache.get_host('lightsail',awsutil.scope(),n) for n in names ]
+        if all(h and h[4] == 'running' for h in hosts):
+            return [ cached(h) for h in hosts ],True
+    return select(instances(client('lightsail')),names,running),False
+
+def sshconn(instance,*options):
+    return conn(keypath(instance['sshKeyName']),instance['username'],instance['publicIpAddress'],*options)
 
 @click.group()
-def cli():
-    pass
+@click.option('--no-cache',is_flag=True,help='Bypass response cache')
+@click.option('--refresh',is_flag=True,help='Refresh cached responses')
+@click.option('--ssh-persist',default='10m',envvar='AWS_UTILS_SSH_PERSIST',help='SSH master idle lifetime (0 disables)')
+@click.option('--rate',type=float,default=None,envvar='AWS_UTILS_RATE',help='Max API requests/sec per service and region')
+@click.option('--max-inflight',type=int,default=16,envvar='AWS_UTILS_MAX_INFLIGHT',help='Max concurrent API requests')
+@click.option('--max-attempts',type=int,default=10,envvar='AWS_UTILS_MAX_ATTEMPTS',help='Max attempts per API request')
+@click.option('--verbose','-v',is_flag=True,help='Report API request/retry/throttle counts')
+@click.option('--trace',type=click.Path(dir_okay=False,writable=True),help='Write a timing trace (JSON) to file')
+@click.pass_context
+def cli(ctx,no_cache,refresh,ssh_persist,rate,max_inflight,max_attempts,verbose,trace):
+    cache.configure(enabled=not no_cache,refresh=refresh)
+    sshutil.configure(ssh_persist)
+    awsutil.configure(rate,max_inflight,max_attempts)
+    if verbose:
+        ctx.call_on_close(awsutil.report)
+    if trace:
+        tracing.enable(trace)
+        ctx.call_on_close(tracing.finish)
 
 @cli.command()
 @click.option('--name',default=None,help='Instance name')
 @click.option('--params',default=None,help='Instance parameters')
-def ls(name,params):
+@click.option('--regions',default=None,help="Regions (comma separated or 'all')")
+@click.option('--profiles',default=None,help='Profiles (comma separated)')
+@format_option
+@watch_options
+@report_options
+def ls(name,params,regions,profiles,fmt,interval,until,sort,group_by,count,sums):
+    reporting = bool(sort or group_by or count or sums)
+    if reporting and (interval or until):
+        click.echo("ERROR: --watch/--until can't be used with --sort/--group-by/--count/--sum",err=True)
+        sys.exit(1)
     params = params or '''
         name
         state:state.name
         zone:location.availabilityZone
-        ip:publicIpAddress
+        ip:publicIpAddress?
         blueprint:blueprintId
         user:username
         key:sshKeyName
     '''
-    params = params.split() 
-    lightsail = boto3.client('lightsail')
-    if name:
-        try:
-            instance = lightsail.get_instance(instanceName=name)['instance']
-            click.echo(tabulate([extract(instance,*params)],headers='keys'))
-        except ClientError as e:
-            click.echo(e)
+    params = parse(params)
+    record = params.raw if reporting else params
+    watching = bool(interval or until)
+    if regions or profiles:
+        pairs = targets('lightsail',regions,profiles)
+        def listing(client):
+            return paginate(client,'get_instances','instances')
+        def snapshot():
+            return ( ((a,r,x['name']),{'account':a,'region':r,**record(x)})
+                        for a,r,x in fanout('lightsail',pairs,listing) if not name or x['name'] == name )
     else:
-        try:
-            instances = lightsail.get_instances()['instances']
-            click.echo(tabulate([extract(x,*params) for x in instances],headers='keys'))
-        except ClientError as e:
-            click.echo(e)
+        lightsail = client('lightsail')
+        def snapshot():
+            if not name:
+                return ( (x['name'],record(x)) for x in instances(lightsail) )
+            try:
+                return [ (name,record(lightsail.get_instance(instanceName=name)['instance'])) ]
+            except ClientError as e:
+                # A deleted instance shows up as removed while watching
+                if watching and e.response['Error']['Code'] == 'NotFoundException':
+                    return []
+                raise
+    try:
+        if watching:
+            watch(snapshot,interval,until,fmt)
+        elif reporting:
+            names = (['account','region'] if regions or profiles else []) + params.names
+            write(report((row for k,row in snapshot()),names,params.multi,sort,group_by,count,sums),fmt)
+        else:
+            write((row for k,row in snapshot()),fmt)
+    except ClientError as e:
+        click.echo(e)
 
 @cli.command()
 @click.option('--params',default=None,help='Display parameters')
-def blueprints(params):
+@format_option
+def blueprints(params,fmt):
     params = params or '''
         id:blueprintId
         name
     '''
-    params = params.split()
-    lightsail = boto3.client('lightsail')
+    params = parse(params)
+    lightsail = client('lightsail')
     try:
-        r = lightsail.get_blueprints()['blueprints']
-        click.echo(tabulate([extract(x,*params) for x in r],headers='keys'))
+        write((params(x) for x in cache.paginate(lightsail,'get_blueprints','blueprints')),fmt)
     except ClientError as e:
         click.echo(e)
 
 @cli.command()
 @click.option('--params',default=None,help='Display parameters')
-def bundles(params):
+@format_option
+def bundles(params,fmt):
     params = params or '''
         id:bundleId
         cpu:cpuCount
@@ -84,11 +166,10 @@ def bundles(params):
         disk:diskSizeInGb
         transfer:transferPerMonthInGb
     '''
-    params = params.split()
-    lightsail = boto3.client('lightsail')
+    params = parse(params)
+    lightsail = client('lightsail')
     try:
-        r = lightsail.get_bundles()['bundles']
-        click.echo(tabulate([extract(x,*params) for x in r],headers='keys'))
+        write((params(x) for x in cache.paginate(lightsail,'get_bundles','bundles')),fmt)
     except ClientError as e:
         click.echo(e)
 
@@ -97,33 +178,35 @@ def bundles(params):
 @click.option('--name',default=None,help='Key name')
 @click.option('--new',default=None,help='SSH public key',type=click.File())
 @click.option('--delete',default=None,help='Delete key')
-def keys(params,new,name,delete):
+@format_option
+def keys(params,new,name,delete,fmt):
     params = params or '''
         name
         zone:location.regionName
     '''
-    params = params.split()
-    lightsail = boto3.client('lightsail')
+    params = parse(params)
+    lightsail = client('lightsail')
     if new:
         if not name:
             click.echo("ERROR: Key name required (--name)")
             return
         try:
             r = lightsail.import_key_pair(keyPairName=name,publicKeyBase64=new.read())['operation']
-            click.echo(tabulate([extract(r,'name:resourceName','status')],headers='keys')) 
+            cache.invalidate('lightsail','get_key_pairs')
+            write([extract(r,'name:resourceName','status')],fmt)
         except ClientError as e:
             click.echo(e)
     elif delete:
         try:
             r = lightsail.delete_key_pair(keyPairName=delete)['operation']
-            click.echo(tabulate([extract(r,'name:resourceName','status')],headers='keys')) 
+            cache.invalidate('lightsail','get_key_pairs')
+            write([extract(r,'name:resourceName','status')],fmt)
         except ClientError as e:
             click.echo(e)
 
     else:
         try:
-            data = lightsail.get_key_pairs()['keyPairs']
-            click.echo(tabulate([extract(x,*params) for x in data],headers='keys'))
+            write((params(x) for x in cache.paginate(lightsail,'get_key_pairs','keyPairs')),fmt)
         except ClientError as e:
             click.echo(e)
 
@@ -131,141 +214,302 @@ def keys(params,new,name,delete):
 @click.argument('name',nargs=1,required=True)
 @click.argument('cmd',nargs=-1)
 def ssh(name,cmd):
-    lightsail = boto3.client('lightsail')
     try:
-        instance = lightsail.get_instance(instanceName=name)['instance']
+        instance,hit = resolve_one(name)
     except ClientError as e:
-        click.echo(e)
-    keypath = '{home}/.ssh/{key}'.format(home=os.getenv('HOME'),key=getpath(instance,'sshKeyName'))
-    args = [ 'ssh', 
-             '-i', keypath,
-             '-l', getpath(instance,'username'),
-             getpath(instance,'publicIpAddress') ]
-    if cmd:
-        args.extend([' '.join(cmd)])
-    subprocess.run(args)
+        click.echo(e,err=True)
+        sys.exit(1)
+    def run(i):
+        c = sshconn(i)
+        return subprocess.run(args(c,' '.join(cmd)) if cmd else args(c)).returncode
+    rc = run(instance)
+    # ssh exits with 255 on connection errors - if the endpoint came from
+    # the cache re-resolve it and retry if it has changed
+    if rc == 255 and hit:
+        cache.drop_host('lightsail',awsutil.scope(),name)
+        fresh,hit = resolve_one(name,refresh=True)
+        if endpoint(fresh) != endpoint(instance):
+            rc = run(fresh)
+    sys.exit(rc)
 
 @cli.command()
-@click.option('--name',required=True,help="Instance name")
+@click.option('--name',multiple=True,help="Instance name(s) or glob")
+@click.option('--all','running',is_flag=True,help="All running instances")
 @click.option('--cmd',help="Command")
-@click.option('--timeout',type=float,default=None,help="Timeout")
-@click.option('--pipe',help='Pipe file to stdin',type=click.File())
-def cmd(name,cmd,timeout,pipe):
-    lightsail = boto3.client('lightsail')
-    try:
-        instance = lightsail.get_instance(instanceName=name)['instance']
-        keypath = '{home}/.ssh/{key}'.format(home=os.getenv('HOME'),key=getpath(instance,'sshKeyName'))
-        args = [ 'ssh', 
-                 '-i', keypath,
-                 '-l', getpath(instance,'username'),
-                 '-o', 'StrictHostKeyChecking=no',
-                 getpath(instance,'publicIpAddress'),
-                 cmd or "uname -a" ]
+@click.option('--timeout',type=float,default=None,help="Timeout (per host)")
+@click.option('--pipe',help='Pipe file to stdin (streamed to every host)',type=click.File('rb'))
+@click.option('--compress',type=click.Choice(['gzip','zstd']),default=None,
+                help="Compress --pipe data on the wire (decompressed remotely)")
+@click.option('--parallel',default=20,help="Max concurrent sessions")
+@click.option('--collect',is_flag=True,help="Collect output per host")
+def cmd(name,running,cmd,timeout,pipe,compress,parallel,collect):
+    if not (name or running):
+        click.echo("ERROR: Instance name required (--name/--all)",err=True)
+        sys.exit(1)
+    if compress and not pipe:
+        click.echo("ERROR: --compress requires --pipe",err=True)
+        sys.exit(1)
+    if compress == 'zstd':
         try:
-            check_key(keypath)
-            if pipe:
-                result = subprocess.run(args,timeout=timeout,stdin=pipe)
-            else:
-                result = subprocess.run(args,timeout=timeout)
-            sys.exit(result.returncode)
-        except subprocess.TimeoutExpired as e:
+            import zstandard
+        except ImportError:
+            click.echo("ERROR: --compress zstd requires zstandard (pip install zstandard)",err=True)
             sys.exit(1)
+    try:
+        matched,hit = resolve(name,running)
     except ClientError as e:
         click.echo(e,err=True)
         sys.exit(1)
+    unknown = missing(matched,name)
+    if not matched:
+        click.echo("ERROR: No matching instances",err=True)
+        sys.exit(1)
+    for i in [ i for i in matched if not i.get('publicIpAddress') ]:
+        click.echo("WARNING: No public IP: {} ({})".format(i['name'],i['state']['name']),err=True)
+    matched = { i['name']:i for i in matched if i.get('publicIpAddress') }
+    for key in { i['sshKeyName'] for i in matched.values() }:
+        check_key(keypath(key))
+    def hosts(instances):
+        return [ (i['name'],sshconn(i,'StrictHostKeyChecking=no')) for i in instances ]
+    def stale(results):
+        # Cached endpoints whose connection failed (ssh exits with 255) are
+        # dropped and re-resolved, returning those that have changed
+        failed = [ n for n,rc in results.items() if rc == 255 ] if hit else []
+        for n in failed:
+            cache.drop_host('lightsail',awsutil.scope(),n)
+        if not failed:
+            return []
+        fresh = select(instances(client('lightsail')),failed)
+        return [ i for i in fresh if i.get('publicIpAddress') and endpoint(i) != endpoint(matched[i['name']]) ]
+    if len(matched) == 1 and not (collect or compress):
+        def run(i):
+            try:
+                return subprocess.run(args(hosts([i])[0][1],cmd or "uname -a"),timeout=timeout,stdin=pipe).returncode
+            except subprocess.TimeoutExpired as e:
+                return None
+        (n,instance), = matched.items()
+        rc = run(instance)
+        for fresh in stale({n:rc}):
+            if pipe and pipe.seekable():
+                pipe.seek(0)
+            rc = run(fresh)
+        sys.exit(1 if rc is None else rc or int(unknown))
+    from sshrun import run_all,summary
+    results = run_all(hosts(matched.values()),cmd or "uname -a",source=pipe,compress=compress,
+                      parallel=parallel,timeout=timeout,collect=collect)
+    retry = stale(results)
+    if retry and pipe and not pipe.seekable():
+        click.echo("WARNING: Not retrying {} (--pipe input is not seekable)".format(
+                        ','.join(i['name'] for i in retry)),err=True)
+        retry = []
+    if retry:
+        if pipe:
+            pipe.seek(0)
+        results.update(run_all(hosts(retry),cmd or "uname -a",source=pipe,compress=compress,
+                                parallel=parallel,timeout=timeout,collect=collect))
+    sys.exit(summary(results) or int(unknown))
+
+async def wait_ready(lightsail,names,options):
+    # One get_instances listing per round (with backoff) until each
+    # instance is running with an IP, then wait for ssh concurrently
+    import asyncio
+    from sshrun import wait_ssh
+    loop = asyncio.get_running_loop()
+    pending,ready,waiting,delay = set(names),{},[],1
+    def progress():
+        click.echo("\rWaiting: {}/{} ready".format(len(ready),len(names)),nl=False,err=True)
+    async def wait(i):
+        c = sshconn(i,*options)
+        await wait_ssh(c)
+        ready[i['name']] = c
+        progress()
+    progress()
+    while pending:
+        listing = await loop.run_in_executor(None,lambda: list(instances(lightsail)))
+        for i in listing:
+            if i['name'] in pending and i['state']['name'] == 'running' and 'publicIpAddress' in i:
+                pending.discard(i['name'])
+                waiting.append(asyncio.ensure_future(wait(i)))
+        if pending:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2,10)
+    await asyncio.gather(*waiting)
+    click.echo(err=True)
+    return [ (name,ready[name]) for name in names ]
 
 @cli.command()
-@click.option('--name',help='Instance name(s)',required=True)
+@click.option('--name',help='Instance name(s) (prefix with --count)',required=True,multiple=True)
+@click.option('--count',type=int,default=None,help='Create COUNT instances named NAME-1..NAME-COUNT')
 @click.option('--zone',help='Availability zone',required=True,envvar="LS_ZONE")
 @click.option('--blueprint',help='Blueprint ID',required=True,envvar="LS_BLUEPRINT")
 @click.option('--bundle',help='Bundle ID',required=True,envvar="LS_BUNDLE")
 @click.option('--key',help='Keypair name',required=True,envvar="LS_KEY")
 @click.option('--userdata',help='Userdata',default='')
 @click.option('--shell',help='Connect once instance initialised',is_flag=True)
-@click.option('--config',help='Exec config file',type=click.File())
-def new(name,zone,blueprint,bundle,key,userdata,shell,config):
-    lightsail = boto3.client('lightsail')
+@click.option('--config',help='Exec config file',type=click.File('rb'))
+@click.option('--parallel',default=20,help="Max concurrent config sessions")
+def new(name,count,zone,blueprint,bundle,key,userdata,shell,config,parallel):
+    if count:
+        if len(name) != 1:
+            click.echo("ERROR: --count takes a single name prefix",err=True)
+            sys.exit(1)
+        names = [ '{}-{}'.format(name[0],n) for n in range(1,count+1) ]
+    else:
+        names = list(name)
+    if shell and len(names) > 1:
+        click.echo("ERROR: --shell needs a single instance",err=True)
+        sys.exit(1)
+    lightsail = client('lightsail')
     try:
-        r = lightsail.create_instances(instanceNames=(name,),
+        r = lightsail.create_instances(instanceNames=names,
                                        availabilityZone=zone,
                                        blueprintId=blueprint,
                                        bundleId=bundle,
                                        keyPairName=key,
                                        userData=userdata)
         if shell or config:
-            instance = lightsail.get_instance(instanceName=name)['instance']
-            keypath = '{home}/.ssh/{key}'.format(home=os.getenv('HOME'),key=getpath(instance,'sshKeyName'))
-            cmd = [ 'ssh', 
-                    '-i', keypath,
-                    '-l', getpath(instance,'username'),
-                    '-o', 'StrictHostKeyChecking=no',
-                    getpath(instance,'publicIpAddress'),
-                    "uname -a" ]
-            n = 0
-            check_key(keypath)
-            while True:
-                click.echo("\rWaiting" + "." * n,nl=False)
-                try:
-                    result = subprocess.run(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,timeout=1)
-                    if result.returncode == 0:
-                        click.echo()
-                        click.echo(result.stdout,nl=False)
-                        break
-                    else:
-                        time.sleep(1)
-                except subprocess.TimeoutExpired as e:
-                    pass
-                n += 1
-            time.sleep(1)
+            import asyncio
+            from sshrun import run_all,summary
+            check_key(keypath(key))
+            hosts = asyncio.run(wait_ready(lightsail,names,('StrictHostKeyChecking=no',)))
             if config:
-                conf = cmd[:-1] + ["sudo bash -vx"] 
-                print(conf)
-                result = subprocess.run(conf,stdin=config)
-                if result.returncode != 0:
-                    sys.exit(result.returncode)
+                results = run_all(hosts,"sudo bash -vx",source=config,parallel=parallel)
+                if any(rc != 0 for rc in results.values()):
+                    sys.exit(summary(results))
             if shell:
-                shell = cmd[:-1]
-                result = subprocess.run(shell)
+                result = subprocess.run(args(hosts[0][1]))
                 sys.exit(result.returncode)
         else:
-            click.echo(tabulate([extract(x,'name:resourceName','zone:location.availabilityZone','status','id') 
-                                    for x in r['operations']],headers='keys'))
+            table([extract(x,'name:resourceName','zone:location.availabilityZone','status','id') 
+                                    for x in r['operations']])
     except ClientError as e:
         click.echo(e)
 
+# Lightsail port infos as secgroups rule tuples (protocol "all" is -1),
+# so that desired port sets share the syncsg rule format and diff
+
+def port_rules(infos):
+    res = []
+    for p in infos:
+        proto = secgroups.protocol(p['protocol'])
+        fp,tp = (-1,-1) if proto == '-1' else (p['fromPort'],p['toPort'])
+        res.extend((proto,fp,tp,s) for s in p.get('cidrs',[]) + p.get('ipv6Cidrs',[]) + p.get('cidrListAliases',[]))
+    return res
+
+def port_infos(rules):
+    res = {}
+    for proto,fp,tp,s in sorted(rules):
+        # parse_rule has already made tcp/udp wildcards 0-65535; icmp
+        # keeps -1 (type/code) and 'all' is sent as the full range
+        p = res.setdefault((proto,fp,tp),{ 'protocol':'all' if proto == '-1' else proto,
+                                           'fromPort':0 if proto == '-1' else fp,
+                                           'toPort':65535 if proto == '-1' else tp })
+        net = secgroups.network(s)
+        key = 'cidrListAliases' if not net else 'cidrs' if net.version == 4 else 'ipv6Cidrs'
+        p.setdefault(key,[]).append(s)
+    return list(res.values())
+
+def parse_port(spec):
+    ports,proto = spec.split('/') if '/' in spec else (spec,'tcp')
+    start,end = [ int(x) for x in (ports.split('-') if '-' in ports else (ports,ports)) ]
+    return { 'fromPort':start, 'toPort':end, 'protocol':proto }
+
+def parallel_map(fn,items,parallel):
+    # fn(item) -> row; API errors are reported in the row
+    def call(i):
+        try:
+            return fn(i)
+        except ClientError as e:
+            return { 'name':i['name'],'status':'error','error':str(e) }
+    with ThreadPoolExecutor(max_workers=max(1,min(parallel,len(items)))) as pool:
+        return list(pool.map(call,items))
+
 @cli.command()
-@click.option('--name',required=True,help='Instance name')
+@click.option('--name',multiple=True,help='Instance name(s) or glob')
+@click.option('--all','every',is_flag=True,help='All instances')
 @click.option('--add',help='Add port (from-to/proto)')
 @click.option('--rm',help='Remove port (from-to/proto)')
-def ports(name,add,rm):
-    lightsail = boto3.client('lightsail')
+@click.option('--set','rules',multiple=True,help='Desired rule, replaces all others (eg. tcp/*:22, tcp/10.0.0.0/8:5432)')
+@click.option('--rules','rules_file',type=click.File(),help='Desired rules file (YAML, as ec2.py syncsg)')
+@click.option('--audit',is_flag=True,help='Report drift from the desired rules only')
+@click.option('--parallel',default=20,help='Max concurrent requests')
+@format_option
+def ports(name,every,add,rm,rules,rules_file,audit,parallel,fmt):
+    if not (name or every):
+        click.echo("ERROR: Instance name required (--name/--all)",err=True)
+        sys.exit(1)
+    desired = None
+    if rules or rules_file:
+        specs = list(rules)
+        if rules_file:
+            try:
+                import yaml
+            except ImportError:
+                click.echo("ERROR: --rules requires PyYAML",err=True)
+                sys.exit(1)
+            specs.extend(yaml.safe_load(rules_file) or [])
+        desired = sorted({ r for spec in specs for r in secgroups.parse_rule(spec) })
+    elif audit:
+        click.echo("ERROR: --audit requires desired rules (--set/--rules)",err=True)
+        sys.exit(1)
+    lightsail = client('lightsail')
+    single = len(name) == 1 and not every and not set(name[0]) & set('*?[')
+    unknown = False
     try:
-        if add:
-            ports,proto = add.split('/') if '/' in add else (add,'tcp')
-            start,end = [ int(x) for x in (ports.split('-') if '-' in ports else (ports,ports)) ]
-            r = lightsail.open_instance_public_ports(instanceName = name,
-                            portInfo = { 'fromPort':start, 'toPort':end, 'protocol':proto })
-            click.echo(tabulate([extract(r['operation'],'name:resourceName','details:operationDetails','status')],
-                                    headers='keys')) 
-        elif rm:
-            ports,proto = rm.split('/') if '/' in rm else (rm,'tcp')
-            start,end = [ int(x) for x in (ports.split('-') if '-' in ports else (ports,ports)) ]
-            r = lightsail.close_instance_public_ports(instanceName = name,
-                            portInfo = { 'fromPort':start, 'toPort':end, 'protocol':proto })
-            click.echo(tabulate([extract(r['operation'],'name:resourceName','details:operationDetails','status')],
-                                    headers='keys')) 
+        if single and desired is None and not (add or rm):
+            ports = lightsail.get_instance_port_states(instanceName=name[0])['portStates']
+            write(ports,fmt)
+            return
+        if single:
+            matched = [ lightsail.get_instance(instanceName=name[0])['instance'] if desired else { 'name':name[0] } ]
         else:
-            ports = lightsail.get_instance_port_states(instanceName=name)['portStates']
-            click.echo(tabulate(ports,headers='keys'))
+            # One listing gives every instance's open ports
+            matched = select(instances(lightsail),['*'] if every else name)
+            unknown = not every and missing(matched,name)
     except ClientError as e:
         click.echo(e)
+        sys.exit(1)
+    if not matched:
+        click.echo("ERROR: No matching instances",err=True)
+        sys.exit(1)
+    if desired is not None:
+        def drift(i):
+            add,remove = secgroups.diff(port_rules(i['networking']['ports']),desired)
+            return { 'name':i['name'],'add':' '.join(map(secgroups.format_rule,add)),
+                                      'remove':' '.join(map(secgroups.format_rule,remove)) }
+        changes = [ drift(i) for i in matched ]
+        if audit:
+            drifted = [ c for c in changes if c['add'] or c['remove'] ]
+            write(drifted,fmt)
+            sys.exit(1 if drifted or unknown else 0)
+        pending = { c['name'] for c in changes if c['add'] or c['remove'] }
+        infos = port_infos(desired)
+        def apply(i):
+            if i['name'] not in pending:
+                return { 'name':i['name'],'status':'unchanged' }
+            r = lightsail.put_instance_public_ports(instanceName=i['name'],portInfos=infos)
+            return { 'name':i['name'],'status':r['operation']['status'] }
+        rows = [ {**c,**r} for c,r in zip(changes,parallel_map(apply,matched,parallel)) ]
+    elif add or rm:
+        info = parse_port(add or rm)
+        op = lightsail.open_instance_public_ports if add else lightsail.close_instance_public_ports
+        def apply(i):
+            r = op(instanceName=i['name'],portInfo=info)
+            return extract(r['operation'],'name:resourceName','details:operationDetails','status')
+        rows = parallel_map(apply,matched,parallel)
+    else:
+        rows = [ { 'name':i['name'],'rule':secgroups.format_rule(r) }
+                    for i in matched for r in sorted(port_rules(i['networking']['ports'])) ]
+    write(rows,fmt)
+    if unknown or any(r.get('status') == 'error' for r in rows):
+        sys.exit(1)
 
 
 @cli.command()
 @click.option('--name',required=True,help='Instance name')
 @click.option('--force',help='Dont ask for conformation',is_flag=True)
 def rm(name,force):
-    lightsail = boto3.client('lightsail')
+    lightsail = client('lightsail')
     try:
         i = lightsail.get_instance(instanceName=name)['instance']
         if force:
@@ -275,8 +519,9 @@ def rm(name,force):
                     extract(i,'name','ip:publicIpAddress','zone:location.availabilityZone','state:state.name')))
         if ok:
             r = lightsail.delete_instance(instanceName=name)
-            click.echo(tabulate([extract(x,'name:resourceName','zone:location.availabilityZone','status') 
-                                        for x in r['operations']],headers='keys'))
+            cache.drop_host('lightsail',awsutil.scope(),name)
+            table([extract(x,'name:resourceName','zone:location.availabilityZone','status') 
+                                        for x in r['operations']])
     except ClientError as e:
         click.echo(e)
 
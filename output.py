@@ -0,0 +1,99 @@
+import csv
+import json
+import sys
+import time
+
+from itertools import islice
+
+import click
+
+import tracing
+
+CHUNK = 100
+
+def fmt(v):
+    return '' if v is None else str(v)
+
+def isnum(v):
+    return isinstance(v,(int,float)) and not isinstance(v,bool)
+
+def table(rows,chunk=CHUNK):
+    # Rows are written a chunk at a time as they arrive instead of buffering
+    # the whole listing. Column widths come from the rows seen so far; when
+    # a later chunk has longer values the columns are widened and the
+    # header is printed again above it.
+    rows = iter(rows)
+    head = list(islice(rows,chunk))
+    if not head:
+        return
+    keys = list(dict.fromkeys(k for r in head for k in r))
+    num = set(keys)
+    def line(r):
+        return '  '.join(fmt(r.get(k)).rjust(width[k]) if k in num else fmt(r.get(k)).ljust(width[k])
+                            for k in keys).rstrip()
+    width = None
+    while head:
+        num &= { k for k in keys if all(isnum(r[k]) for r in head if k in r) }
+        wider = { k:max(len(k),*(len(fmt(r.get(k))) for r in head)) for k in keys }
+        lines = []
+        if width is None or any(wider[k] > width[k] for k in keys):
+            # A blank line separates a re-printed header from the rows above
+            lines = [''] if width else []
+            width = { k:max(wider[k],width[k]) if width else wider[k] for k in keys }
+            lines.extend([ line({k:k for k in keys}), '  '.join('-' * width[k] for k in keys) ])
+        lines.extend(line(r) for r in head)
+        click.echo('\n'.join(lines))
+        head = list(islice(rows,chunk))
+
+class Writer:
+
+    # Line oriented writer that flushes every `chunk` rows, or sooner if
+    # rows are arriving slowly, so downstream consumers see them promptly
+
+    def __init__(self,chunk=CHUNK,interval=0.5):
+        self.out,self.chunk,self.interval = sys.stdout,chunk,interval
+        self.n,self.last = 0,time.monotonic()
+
+    def write(self,s):
+        self.out.write(s)
+        self.n += 1
+        if self.n >= self.chunk or time.monotonic() - self.last > self.interval:
+            self.flush()
+
+    def flush(self):
+        self.out.flush()
+        self.n,self.last = 0,time.monotonic()
+
+def jsonl(rows,chunk=CHUNK):
+    w = Writer(chunk)
+    for r in rows:
+        w.write(json.dumps(r,default=str) + '\n')
+    w.flush()
+
+def delimited(rows,dialect,chunk=CHUNK):
+    # Columns are taken from the first row (continuation rows may only
+    # carry some of them)
+    rows = iter(rows)
+    first = next(rows,None)
+    if first is None:
+        return
+    w = Writer(chunk)
+    out = csv.DictWriter(w,fieldnames=list(first),dialect=dialect,extrasaction='ignore',restval='')
+    out.writeheader()
+    out.writerow(first)
+    for r in rows:
+        out.writerow(r)
+    w.flush()
+
+FORMATS = { 'table': table,
+            'jsonl': jsonl,
+            'csv': lambda rows,chunk=CHUNK: delimited(rows,'excel',chunk),
+            'tsv': lambda rows,chunk=CHUNK: delimited(rows,'excel-tab',chunk) }
+
+def write(rows,output='table',chunk=CHUNK):
+    with tracing.span('output',output):
+        FORMATS[output](rows,chunk)
+
+def format_option(f):
+    return click.option('--output','-o','fmt',type=click.Choice(list(FORMATS)),default='table',
+                            help='Output format')(f)
@@ -0,0 +1,251 @@
+import ipaddress
+
+from itertools import groupby
+
+# Security group rules are handled as flat (proto,from,to,source) tuples
+# where source is an IPv4/IPv6 CIDR, a security group id or a prefix list
+# id. Rule strings use the listsg format: proto/source:ports
+# (eg. tcp/*:22, udp/10.0.0.0/8:500-510, tcp/::/0:443, */sg-1234:*).
+
+PROTOCOLS = { '6':'tcp', '17':'udp', '1':'icmp', '58':'icmpv6', '-1':'-1', 'all':'-1', '*':'-1' }
+
+ALL_PORTS = (0,65535)
+
+def protocol(p):
+    p = str(p).lower()
+    return PROTOCOLS.get(p,p)
+
+def rules(perms):
+    res = []
+    for p in perms:
+        proto = protocol(p['IpProtocol'])
+        fp,tp = p.get('FromPort',-1),p.get('ToPort',-1)
+        if proto == '-1':
+            fp,tp = -1,-1
+        res.extend((proto,fp,tp,r['CidrIp']) for r in p.get('IpRanges',[]))
+        res.extend((proto,fp,tp,r['CidrIpv6']) for r in p.get('Ipv6Ranges',[]))
+        res.extend((proto,fp,tp,r['GroupId']) for r in p.get('UserIdGroupPairs',[]))
+        res.extend((proto,fp,tp,r['PrefixListId']) for r in p.get('PrefixListIds',[]))
+    return res
+
+def ports(fp,tp):
+    if fp == -1 and tp == -1:
+        return '*'
+    return "{}".format(fp) if fp == tp else "{}-{}".format(fp,tp)
+
+def source(s):
+    return '*' if s == '0.0.0.0/0' else s
+
+def format_rule(r):
+    proto,fp,tp,s = r
+    return "{}/{}:{}".format('*' if proto == '-1' else proto,source(s),ports(fp,tp))
+
+def format_permission(proto,fp,tp,sources):
+    return "{}/{}:{}".format('*' if proto == '-1' else proto,",".join(source(s) for s in sources),ports(fp,tp))
+
+def parse_ports(p):
+    if p in ('*','-1',None,''):
+        return -1,-1
+    fp,tp = str(p).split('-',1) if '-' in str(p) else (p,p)
+    return int(fp),int(tp)
+
+def parse_source(s):
+    return '0.0.0.0/0' if s == '*' else s
+
+def parse_rule(r):
+    # Either a rule string or a mapping with proto/ports/cidr (a CIDR or
+    # group id, or a list of them)
+    if isinstance(r,str):
+        proto,rest = r.split('/',1)
+        s,p = rest.rsplit(':',1)
+        sources = [s]
+    else:
+        proto,p = r.get('proto','tcp'),r.get('ports','*')
+        sources = r.get('cidr') or r.get('source')
+        sources = [sources] if isinstance(sources,str) else sources
+    proto = protocol(proto)
+    fp,tp = (-1,-1) if proto == '-1' else parse_ports(p)
+    # Only icmp takes -1 (every type); EC2 stores other wildcards as 0-65535
+    if (fp,tp) == (-1,-1) and proto not in ('-1','icmp','icmpv6'):
+        fp,tp = ALL_PORTS
+    return [ (proto,fp,tp,parse_source(s)) for s in sources ]
+
+def permissions(rules):
+    # Group rules into as few IpPermissions entries as possible
+    res = []
+    key = lambda r: r[:3]
+    for (proto,fp,tp),group in groupby(sorted(rules,key=key),key=key):
+        p = { 'IpProtocol': proto }
+        if proto != '-1':
+            p.update(FromPort=fp,ToPort=tp)
+        for r in group:
+            s = r[3]
+            if s.startswith('sg-'):
+                p.setdefault('UserIdGroupPairs',[]).append({'GroupId':s})
+            elif s.startswith('pl-'):
+                p.setdefault('PrefixListIds',[]).append({'PrefixListId':s})
+            elif ':' in s:
+                p.setdefault('Ipv6Ranges',[]).append({'CidrIpv6':s})
+            else:
+                p.setdefault('IpRanges',[]).append({'CidrIp':s})
+        res.append(p)
+    return res
+
+def diff(current,desired):
+    current,desired = set(current),set(desired)
+    return sorted(desired - current),sorted(current - desired)
+
+# Indexed queries over many groups: port ranges go into a static centered
+# interval tree and CIDR sources into a binary prefix trie per address
+# family, so overlap/containment lookups do not scan every rule. Protocol
+# -1 rules cover every port (as do icmp rules, whose "ports" are types).
+
+class Intervals:
+
+    def __init__(self,items):
+        # items: {(lo,hi):[values]}
+        self.root = self.build(sorted(items.items()))
+
+    def build(self,items):
+        if not items:
+            return None
+        ends = sorted(e for (lo,hi),v in items for e in (lo,hi))
+        center = ends[len(ends) // 2]
+        here = [ i for i in items if i[0][0] <= center <= i[0][1] ]
+        return (center,
+                here,                                       # sorted by lo
+                sorted(here,key=lambda i: -i[0][1]),        # by hi, descending
+                self.build([ i for i in items if i[0][1] < center ]),
+                self.build([ i for i in items if i[0][0] > center ]))
+
+    def overlap(self,lo,hi):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            center,bylo,byhi,left,right = node
+            if hi < center:
+                for (l,h),v in bylo:
+                    if l > hi:
+                        break
+                    yield from v
+                stack.append(left)
+            elif lo > center:
+                for (l,h),v in byhi:
+                    if h < lo:
+                        break
+                    yield from v
+                stack.append(right)
+            else:
+                for i,v in bylo:
+                    yield from v
+                stack.extend((left,right))
+
+class Trie:
+
+    def __init__(self):
+        self.roots = {}
+
+    def node(self,net,create=False):
+        n = self.roots.get(net.version)
+        if n is None:
+            if not create:
+                return None
+            n = self.roots[net.version] = [None,None,[]]
+        bits = int(net.network_address)
+        for i in range(net.prefixlen):
+            b = bits >> (net.max_prefixlen - 1 - i) & 1
+            if n[b] is None:
+                if not create:
+                    return None
+                n[b] = [None,None,[]]
+            n = n[b]
+        return n
+
+    def add(self,net,values):
+        self.node(net,create=True)[2].extend(values)
+
+    def containing(self,net):
+        # Prefixes equal to or wider than net
+        n = self.roots.get(net.version)
+        bits = int(net.network_address)
+        for i in range(net.prefixlen + 1):
+            if n is None:
+                return
+            yield from n[2]
+            if i < net.prefixlen:
+                n = n[bits >> (net.max_prefixlen - 1 - i) & 1]
+
+    def within(self,net):
+        # Prefixes equal to or narrower than net
+        stack = [self.node(net)]
+        while stack:
+            n = stack.pop()
+            if n is not None:
+                yield from n[2]
+                stack.extend(n[:2])
+
+class Index:
+
+    def __init__(self,groups,egress=False):
+        self.groups = {}
+        self.entries = []
+        ranges,self.sources,self.trie = {},{},Trie()
+        for sg in groups:
+            self.groups[sg['GroupId']] = sg
+            for r in rules(sg['IpPermissionsEgress' if egress else 'IpPermissions']):
+                n = len(self.entries)
+                self.entries.append((sg['GroupId'],r))
+                ranges.setdefault(portrange(r),[]).append(n)
+                self.sources.setdefault(r[3],[]).append(n)
+        # Sources repeat a lot, so each distinct CIDR goes into the trie
+        # once with all of its entries
+        for s in list(self.sources):
+            net = network(s)
+            if net:
+                self.trie.add(net,self.sources.pop(s))
+        self.ports = Intervals(ranges)
+
+    def query(self,proto=None,ports=None,cidr=None,match='contains',source=None):
+        # Returns (group id,rule) for rules matching every given condition;
+        # match is how the rule source relates to cidr: contains (the rule
+        # admits all of cidr), within (rule is inside cidr) or overlap
+        sets = []
+        if cidr:
+            net = network(cidr)
+            found = set()
+            if match in ('contains','overlap'):
+                found.update(self.trie.containing(net))
+            if match in ('within','overlap'):
+                found.update(self.trie.within(net))
+            sets.append(found)
+        if source:
+            sets.append(set(self.sources.get(source,())))
+        if sets:
+            # Source matches are usually few, cheaper to check their ports
+            # directly than to intersect with the port index
+            ids = set.intersection(*sorted(sets,key=len))
+            if ports:
+                ids = [ n for n in ids if overlaps(self.entries[n][1],ports) ]
+        elif ports:
+            ids = self.ports.overlap(*ports)
+        else:
+            ids = range(len(self.entries))
+        proto = protocol(proto) if proto else None
+        return [ self.entries[n] for n in sorted(ids)
+                    if not proto or proto == '-1' or self.entries[n][1][0] in (proto,'-1') ]
+
+def portrange(r):
+    proto,fp,tp,s = r
+    return ALL_PORTS if proto in ('-1','icmp','icmpv6') or fp == -1 else (fp,tp)
+
+def overlaps(r,ports):
+    lo,hi = portrange(r)
+    return lo <= ports[1] and hi >= ports[0]
+
+def network(s):
+    try:
+        return ipaddress.ip_network(s,strict=False)
+    except ValueError:
+        return None
@@ -0,0 +1,231 @@
+import asyncio
+import collections
+import os
+import tempfile
+import zlib
+
+import click
+
+import tracing
+
+from sshutil import args,controlpath,mux
+
+# asyncio based ssh sessions, kept apart from sshutil so that the
+# interactive commands do not pay for importing asyncio
+
+BLOCK = 256 * 1024
+RING = 64 * 1024 * 1024
+
+DECOMPRESS = { 'gzip':'gzip -dc', 'zstd':'zstd -dc' }
+
+def compressor(kind):
+    if kind == 'gzip':
+        c = zlib.compressobj(6,zlib.DEFLATED,31)
+    elif kind == 'zstd':
+        import zstandard
+        c = zstandard.ZstdCompressor().compressobj()
+    else:
+        return None
+    return c.compress,c.flush
+
+class Ring:
+
+    # The source is read (and compressed) once, in blocks, into a window of
+    # at most `size` bytes that every host streams from at its own pace.
+    # When the window is full the producer waits for the slowest host,
+    # unless others have caught up and are idle: then the hosts holding
+    # the oldest block are detached and carry on reading from a seekable
+    # copy - the source itself if it is a plain file, otherwise a spool
+    # file written alongside. Hosts starting late read from the copy too.
+
+    def __init__(self,source,compress=None,size=RING):
+        self.source,self.size = source,size
+        self.compressor = compressor(compress)
+        self.chunks = collections.deque()
+        self.start = self.end = 0
+        self.eof = False
+        self.readers = {}
+        self.cond = asyncio.Condition()
+        if not compress and source.seekable():
+            self.spool,self.fd,self.base = None,source.fileno(),source.tell()
+        else:
+            self.spool = tempfile.TemporaryFile()
+            self.fd,self.base = self.spool.fileno(),0
+
+    def trim(self):
+        low = min(self.readers.values(),default=self.end)
+        while self.chunks and self.start + len(self.chunks[0]) <= low:
+            self.start += len(self.chunks.popleft())
+
+    def detach(self):
+        first = self.start + len(self.chunks[0])
+        for r,pos in list(self.readers.items()):
+            if pos < first:
+                del self.readers[r]
+        self.trim()
+
+    async def produce(self):
+        loop = asyncio.get_running_loop()
+        while not self.eof:
+            data = await loop.run_in_executor(None,self.source.read,BLOCK)
+            self.eof = not data
+            if self.compressor:
+                data = self.compressor[0](data) if data else self.compressor[1]()
+            if data and self.spool:
+                self.spool.write(data)
+                self.spool.flush()
+            async with self.cond:
+                while data and self.chunks and self.end - self.start + len(data) > self.size:
+                    if not self.readers or self.end in self.readers.values():
+                        self.detach()
+                    else:
+                        await self.cond.wait()
+                if data:
+                    self.chunks.append(data)
+                    self.end += len(data)
+                self.cond.notify_all()
+
+    def block(self,pos):
+        off = self.start
+        for c in self.chunks:
+            if pos < off + len(c):
+                return memoryview(c)[pos - off:]
+            off += len(c)
+
+    async def read(self):
+        # Blocks for one host; the host's position only advances once the
+        # caller asks for the next block (ie. after its write has drained)
+        loop = asyncio.get_running_loop()
+        me,pos = object(),0
+        if self.start == 0:
+            self.readers[me] = 0
+        try:
+            while True:
+                async with self.cond:
+                    while pos >= self.end and not self.eof:
+                        await self.cond.wait()
+                    if pos >= self.end:
+                        return
+                    data = self.block(pos) if me in self.readers else None
+                if data is None:
+                    data = await loop.run_in_executor(None,os.pread,self.fd,min(BLOCK,self.end - pos),self.base + pos)
+                yield data
+                pos += len(data)
+                if me in self.readers:
+                    async with self.cond:
+                        self.readers[me] = pos
+                        self.trim()
+                        self.cond.notify_all()
+        finally:
+            async with self.cond:
+                if self.readers.pop(me,None) is not None:
+                    self.trim()
+                    self.cond.notify_all()
+
+    def close(self):
+        if self.spool:
+            self.spool.close()
+
+async def amaster(c):
+    if mux() and not os.path.exists(controlpath(c)):
+        proc = await asyncio.create_subprocess_exec(*args(c,master=True),stdin=asyncio.subprocess.DEVNULL,
+                        stdout=asyncio.subprocess.DEVNULL,stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+
+async def probe(ip,port=22,timeout=2):
+    try:
+        r,w = await asyncio.wait_for(asyncio.open_connection(ip,port),timeout)
+        w.close()
+        return True
+    except (OSError,asyncio.TimeoutError):
+        return False
+
+async def wait_ssh(c,interval=1):
+    # Cheap TCP probe first, then a real login (which also brings up the
+    # control master so that later sessions reuse it)
+    while not await probe(c['ip']):
+        await asyncio.sleep(interval)
+    c = dict(c,options=c['options'] + ('ConnectTimeout=5','BatchMode=yes'))
+    while True:
+        a = args(c,master=True) if mux() else args(c,'true')
+        proc = await asyncio.create_subprocess_exec(*a,stdin=asyncio.subprocess.DEVNULL,
+                        stdout=asyncio.subprocess.DEVNULL,stderr=asyncio.subprocess.DEVNULL)
+        if await proc.wait() == 0:
+            return
+        await asyncio.sleep(interval)
+
+async def run_host(name,c,cmd,sem,ring,timeout,prefix,collect):
+    async with sem:
+        with tracing.span('ssh',name,key=name,cmd=cmd) as span:
+            await amaster(c)
+            proc = await asyncio.create_subprocess_exec(*args(c,cmd),
+                            stdin=asyncio.subprocess.DEVNULL if ring is None else asyncio.subprocess.PIPE,
+                            stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.STDOUT)
+            out = []
+            async def feed():
+                blocks = ring.read()
+                try:
+                    async for block in blocks:
+                        proc.stdin.write(block)
+                        await proc.stdin.drain()
+                    proc.stdin.close()
+                except (BrokenPipeError,ConnectionResetError):
+                    pass
+                finally:
+                    await blocks.aclose()
+            async def pump():
+                async for line in proc.stdout:
+                    if collect:
+                        out.append(line)
+                    else:
+                        click.echo(prefix + line,nl=False)
+                if writer:
+                    await writer
+                return await proc.wait()
+            writer = asyncio.ensure_future(feed()) if ring is not None else None
+            try:
+                rc = await asyncio.wait_for(pump(),timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                if writer:
+                    writer.cancel()
+                rc = None
+            if collect:
+                click.echo("--- {} ({})".format(name,'timeout' if rc is None else rc))
+                click.echo(b''.join(out),nl=False)
+            span['rc'] = rc
+            return rc
+
+def run_all(hosts,cmd,source=None,parallel=20,timeout=None,collect=False,compress=None):
+    # hosts is a list of (name,conn); returns {name:returncode} with None
+    # for sessions killed on timeout. source (a binary file) is streamed
+    # to every host's stdin, optionally compressed on the wire.
+    width = max(len(name) for name,c in hosts)
+    if source is not None and compress:
+        cmd = "{} | ({})".format(DECOMPRESS[compress],cmd)
+    async def main():
+        sem = asyncio.Semaphore(parallel)
+        ring = Ring(source,compress) if source is not None else None
+        producer = asyncio.ensure_future(ring.produce()) if ring else None
+        try:
+            rc = await asyncio.gather(*[ run_host(name,c,cmd,sem,ring,timeout,
+                                                  '{}: '.format(name.ljust(width)).encode(),collect)
+                                                    for name,c in hosts ])
+        finally:
+            if producer:
+                producer.cancel()
+                ring.close()
+        return dict(zip([ name for name,c in hosts ],rc))
+    return asyncio.run(main())
+
+def summary(results):
+    ok = [ n for n,rc in results.items() if rc == 0 ]
+    timeout = [ n for n,rc in results.items() if rc is None ]
+    failed = [ n for n,rc in results.items() if rc not in (0,None) ]
+    click.echo("{} ok, {} failed, {} timed out".format(len(ok),len(failed),len(timeout)),err=True)
+    for n in failed:
+        click.echo("  failed: {} ({})".format(n,results[n]),err=True)
+    for n in timeout:
+        click.echo("  timeout: {}".format(n),err=True)
+    return 0 if len(ok) == len(results) else 1
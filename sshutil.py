@@ -0,0 +1,75 @@
+import json
+import os
+import subprocess
+
+import cache
+
+# Connections are multiplexed over one ControlMaster socket per
+# user@host which stays up for `persist` after the last session ends
+# ('0' disables multiplexing).
+
+CONTROL_DIR = os.path.expanduser('~/.ssh/aws-utils')
+KEYS = os.path.join(cache.DIR,'keys.json')
+
+config = { 'persist': '10m' }
+
+def configure(persist):
+    config['persist'] = persist
+
+def keypath(key):
+    return '{home}/.ssh/{key}'.format(home=os.getenv('HOME'),key=key)
+
+def conn(key,user,ip,*options):
+    return { 'key':key, 'user':user, 'ip':ip, 'options':options }
+
+def controlpath(c):
+    return os.path.join(CONTROL_DIR,'{user}@{ip}'.format_map(c))
+
+def mux():
+    return config['persist'] not in ('0','no','')
+
+def args(c,*cmd,master=False):
+    a = [ 'ssh', '-i', c['key'], '-l', c['user'] ]
+    for o in c['options']:
+        a.extend(['-o',o])
+    if mux():
+        os.makedirs(CONTROL_DIR,mode=0o700,exist_ok=True)
+        a.extend(['-o','ControlMaster={}'.format('yes' if master else 'auto'),
+                  '-o','ControlPath={}'.format(controlpath(c)),
+                  '-o','ControlPersist={}'.format(config['persist'])])
+    if master:
+        a.extend(['-N','-f'])
+    return a + [c['ip']] + list(cmd)
+
+def master(c):
+    # A master started implicitly by ControlMaster=auto can hold on to the
+    # stdout/stderr pipes of the session that created it, so when output is
+    # captured start it explicitly with its stdio detached
+    if mux() and not os.path.exists(controlpath(c)):
+        subprocess.run(args(c,master=True),stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+def check_key(key):
+    # Validation results are cached against the key file mtime (and the
+    # agent socket when the key had to be added to the agent)
+    try:
+        with open(KEYS) as f:
+            known = json.load(f)
+    except (OSError,ValueError):
+        known = {}
+    try:
+        mtime = os.stat(key).st_mtime
+    except OSError:
+        return
+    if known.get(key) in ([mtime,None],[mtime,os.getenv('SSH_AUTH_SOCK')]):
+        return
+    if subprocess.run(['ssh-keygen','-y','-f',key],stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL).returncode == 0:
+        known[key] = [mtime,None]
+    else:
+        agent = subprocess.run(['ssh-add','-l'],stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+        if key.encode() in agent.stdout or subprocess.run(['ssh-add',key]).returncode == 0:
+            known[key] = [mtime,os.getenv('SSH_AUTH_SOCK')]
+    os.makedirs(cache.DIR,exist_ok=True)
+    with open(KEYS,'w') as f:
+        json.dump(known,f)
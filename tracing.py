@@ -0,0 +1,146 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import click
+
+# Lightweight span recorder behind --trace. Spans are written as Chrome
+# trace events (load the file in chrome://tracing or ui.perfetto.dev) and
+# summarised on stderr by self time per category, so an API call made
+# while the output is being written counts as api rather than output.
+
+config = { 'path':None }
+events = []
+lock = threading.Lock()
+tids = {}
+T0 = time.perf_counter()
+NOSPAN = contextlib.nullcontext({})
+
+def enabled():
+    return config['path'] is not None
+
+def tid(key=None):
+    key = threading.get_ident() if key is None else key
+    with lock:
+        return tids.setdefault(key,len(tids) + 1)
+
+def add(cat,name,start,end,key=None,**args):
+    e = { 'cat':cat, 'name':name or cat, 'ph':'X', 'pid':os.getpid(), 'tid':tid(key),
+          'ts':round((start - T0) * 1e6), 'dur':round((end - start) * 1e6), 'args':args }
+    with lock:
+        events.append(e)
+
+@contextlib.contextmanager
+def _span(cat,name,key,args):
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        add(cat,name,start,time.perf_counter(),key,**args)
+
+def span(cat,name=None,key=None,**args):
+    # key puts the span on its own track (e.g. per host for asyncio tasks
+    # that overlap on one thread)
+    return _span(cat,name,key,args) if enabled() else NOSPAN
+
+def enable(path):
+    # Also called once per command by a resident awsd process, so state is
+    # reset here and subprocess.run is only wrapped the first time
+    global T0
+    import subprocess
+    with lock:
+        events.clear()
+        tids.clear()
+    config['path'],T0 = path,time.perf_counter()
+    if getattr(subprocess.run,'traced',False):
+        return
+    run = subprocess.run
+    def traced(cmd,*a,**kw):
+        with span('subprocess',os.path.basename(str(cmd[0])),cmd=' '.join(map(str,cmd))[:200]) as s:
+            result = run(cmd,*a,**kw)
+            s['rc'] = result.returncode
+            return result
+    traced.traced = True
+    subprocess.run = traced
+
+# botocore hooks, registered on each client by awsutil.client (they do
+# nothing unless tracing is enabled)
+
+def hook(client):
+    def before(model,context,**kwargs):
+        if not enabled():
+            return
+        context['trace_op'] = model.name
+        context['trace_start'] = time.perf_counter()
+    def after(http_response,parsed,model,context,**kwargs):
+        if 'trace_start' not in context:
+            return
+        try:
+            size = len(http_response.content)
+        except Exception:
+            size = 0
+        add('api',model.name,context.pop('trace_start',T0),time.perf_counter(),
+                service=client.meta.service_model.service_name,region=client.meta.region_name,
+                bytes=size,retries=parsed.get('ResponseMetadata',{}).get('RetryAttempts',0),
+                status=parsed.get('ResponseMetadata',{}).get('HTTPStatusCode'))
+    def error(exception,context,**kwargs):
+        if 'trace_start' not in context:
+            return
+        add('api',context.get('trace_op'),context.pop('trace_start',T0),time.perf_counter(),
+                service=client.meta.service_model.service_name,region=client.meta.region_name,
+                error=str(exception))
+    client.meta.events.register('before-parameter-build',before)
+    client.meta.events.register('after-call',after)
+    client.meta.events.register('after-call-error',error)
+    return client
+
+# requests response hook (gist)
+
+def http(response,*args,**kwargs):
+    end = time.perf_counter()
+    add('http','{} {}'.format(response.request.method,response.url.split('?')[0]),
+            end - response.elapsed.total_seconds(),end,status=response.status_code,
+            bytes=len(response.content))
+
+def selftime():
+    # Per category time with nested spans on the same track subtracted
+    totals = {}
+    tracks = {}
+    for e in events:
+        tracks.setdefault(e['tid'],[]).append(e)
+    for track in tracks.values():
+        stack = []
+        for e in sorted(track,key=lambda e: (e['ts'],-e['dur'])):
+            while stack and stack[-1]['ts'] + stack[-1]['dur'] <= e['ts']:
+                stack.pop()
+            if stack:
+                totals[stack[-1]['cat']] = totals.get(stack[-1]['cat'],0) - e['dur']
+            totals[e['cat']] = totals.get(e['cat'],0) + e['dur']
+            stack.append(e)
+    return totals
+
+def finish():
+    if not enabled():
+        return
+    add('command',' '.join(sys.argv[1:]) or os.path.basename(sys.argv[0]),T0,time.perf_counter())
+    names = [ { 'ph':'M', 'name':'thread_name', 'pid':os.getpid(), 'tid':n,
+                'args':{ 'name':str(k) if not isinstance(k,int) else 'thread-{}'.format(n) } } for k,n in tids.items() ]
+    with open(config['path'],'w') as f:
+        json.dump({ 'traceEvents':names + events, 'displayTimeUnit':'ms', 'otherData':{ 'argv':sys.argv } },f)
+    api = [ e for e in events if e['cat'] == 'api' ]
+    parts = [ "{:.2f}s wall".format(time.perf_counter() - T0) ]
+    for cat,us in sorted(selftime().items(),key=lambda i: -i[1]):
+        n = sum(1 for e in events if e['cat'] == cat)
+        if cat == 'api':
+            parts.append("api {:.2f}s ({} calls, {} retries, {:.1f}KB)".format(us / 1e6,n,
+                            sum(e['args'].get('retries',0) for e in api),
+                            sum(e['args'].get('bytes',0) for e in api) / 1024))
+        elif cat == 'command':
+            parts.append("other {:.2f}s".format(us / 1e6))
+        else:
+            parts.append("{} {:.2f}s ({})".format(cat,us / 1e6,n))
+    click.echo("trace: {} -> {}".format(" | ".join(parts),config['path']),err=True)
+    config['path'] = None
@@ -0,0 +1,73 @@
+import fnmatch
+import sys
+import time
+
+import click
+
+from output import write
+
+INTERVAL = 5
+
+# Polling for `ls --watch`: each snapshot is a {key:row} mapping and only
+# rows that were added, changed or removed since the previous poll are
+# written. Tables get a fresh header per poll; the line oriented formats
+# are one continuous stream, flushed row by row.
+
+def conditions(until):
+    # --until state=running (glob patterns, all must hold for every row)
+    until = [ tuple(u.split('=',1)) for u in until ]
+    if any(len(u) != 2 or not u[0] for u in until):
+        raise click.BadParameter("expected FIELD=VALUE",param_hint='--until')
+    return until
+
+def converged(rows,until):
+    return bool(rows) and all(fnmatch.fnmatchcase(str(row.get(f,'')),v) for row in rows.values() for f,v in until)
+
+def changes(prev,current):
+    for k,row in current.items():
+        if k not in prev:
+            yield 'added',row
+        elif row != prev[k]:
+            yield 'changed',row
+    for k,row in prev.items():
+        if k not in current:
+            yield 'removed',row
+
+def polls(snapshot,interval,until):
+    prev = {}
+    while True:
+        start = time.monotonic()
+        current = dict(snapshot())
+        if until and current and not prev:
+            unknown = [ f for f,v in until if f not in next(iter(current.values())) ]
+            if unknown:
+                raise click.BadParameter("unknown field: {}".format(','.join(unknown)),param_hint='--until')
+        now = time.strftime('%H:%M:%S')
+        yield [ { 'time':now,'change':c,**row } for c,row in changes(prev,current) ]
+        if until and converged(current,until):
+            return
+        prev = current
+        time.sleep(max(0,interval - (time.monotonic() - start)))
+
+def watch_options(f):
+    f = click.option('--until',multiple=True,help='Stop once every row matches FIELD=VALUE (implies --watch)')(f)
+    return click.option('--watch','interval',type=float,default=None,metavar='INTERVAL',
+                            help='Poll every INTERVAL seconds and show changed rows')(f)
+
+def watch(snapshot,interval,until=(),fmt='table'):
+    # Exits 0 once --until holds, 1 if interrupted before that
+    until = conditions(until)
+    interval = interval or INTERVAL
+    try:
+        if fmt == 'table':
+            first = True
+            for rows in polls(snapshot,interval,until):
+                if rows:
+                    if not first:
+                        click.echo()
+                    write(rows,fmt)
+                    first = False
+        else:
+            write((row for rows in polls(snapshot,interval,until) for row in rows),fmt,chunk=1)
+    except KeyboardInterrupt:
+        sys.exit(1 if until else 0)